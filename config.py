@@ -193,6 +193,16 @@ class Config:
         # 'worker_log_format': LOGGING['formatters']['default']['format'],
         # 'worker_task_log_format': LOGGING['formatters']['celery_tasks']['format'],
         'worker_hijack_root_logger': False,
+        # Tasks that can stay a long time on the worker (waiting with a retry
+        # ETA or holding a database lock) go to their own queue. With a
+        # prefetch of one task, a worker does not reserve tasks that it cannot
+        # execute soon, which would block them or, with late acknowledgement,
+        # schedule them twice.
+        'task_routes': {
+            'quetzal.app.api.data.tasks.wait_for_workspace': {'queue': 'workspace_long_tasks'},
+            'quetzal.app.api.data.tasks.commit_workspace': {'queue': 'workspace_long_tasks'},
+        },
+        'worker_prefetch_multiplier': 1,
     }
 
     # Quetzal-specific configuration
@@ -200,6 +210,8 @@ class Config:
     # data storage: 'GCP' for Google Cloud Platform, 'file' for local storage
     QUETZAL_DATA_STORAGE = os.environ.get('QUETZAL_DATA_STORAGE', 'GCP')
     QUETZAL_BACKGROUND_JOBS = bool(os.environ.get('QUETZAL_BACKGROUND_JOBS', False))
+    # raise an exception on lazy loads of relationships that emit a query
+    QUETZAL_STRICT_LOADING = bool(os.environ.get('QUETZAL_STRICT_LOADING', False))
 
     # Quetzal-GCP storage configuration
     QUETZAL_GCP_CREDENTIALS = os.environ.get('QUETZAL_GCP_CREDENTIALS') or \
@@ -293,6 +305,7 @@ class TestConfig(Config):
 
     # Quetzal-specific configuration
     QUETZAL_GCP_CREDENTIALS = None
+    QUETZAL_STRICT_LOADING = True
     QUETZAL_GCP_DATA_BUCKET = 'gs://quetzal-unit-tests'
 
 
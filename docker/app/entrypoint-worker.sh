@@ -1,4 +1,7 @@
 #!/usr/bin/env bash
 
 # TODO: document on the importance of --concurrency 1 and -Ofair
-celery worker --app wsgi.celery --loglevel DEBUG --concurrency 1 -Ofair
+# The worker consumes the default queue and the queue of long workspace tasks
+# (see the task_routes on the celery configuration)
+celery worker --app wsgi.celery --loglevel DEBUG --concurrency 1 -Ofair \
+    --queues celery,workspace_long_tasks --prefetch-multiplier 1
@@ -0,0 +1,25 @@
+"""indices to find the latest global metadata
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-16 10:12:41.204518
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_family_workspace_id', 'family', ['fk_workspace_id', 'id'], unique=False)
+    op.create_index('ix_metadata_family_id', 'metadata', ['fk_family_id', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_metadata_family_id', table_name='metadata')
+    op.drop_index('ix_family_workspace_id', table_name='family')
@@ -0,0 +1,31 @@
+"""index to find the latest metadata of a file
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-16 21:32:08.511262
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Create the index concurrently so that the metadata table is not locked
+    # while it is built. This cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index('ix_metadata_file_family_id', 'metadata',
+                        ['id_file', 'fk_family_id', sa.text('id DESC')],
+                        unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_metadata_file_family_id', table_name='metadata',
+                      postgresql_concurrently=True)
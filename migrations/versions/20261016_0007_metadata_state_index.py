@@ -0,0 +1,31 @@
+"""index on the state of the metadata
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-16 21:41:53.730194
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Create the index concurrently so that the metadata table is not locked
+    # while it is built. This cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index('ix_metadata_state', 'metadata',
+                        [sa.text("(json->>'state')")],
+                        unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_metadata_state', table_name='metadata',
+                      postgresql_concurrently=True)
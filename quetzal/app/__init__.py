@@ -14,7 +14,7 @@ from ._version import get_version
 from .helpers.celery import Celery
 from .hacks import CustomResponseValidator
 from .middleware.debug import debug_request, debug_response
-from .middleware.gdpr import gdpr_log_request
+from .middleware.gdpr import gdpr_log_request, gdpr_logging_enabled
 from .middleware.headers import HttpHostHeaderMiddleware
 from .security import load_identity
 
@@ -121,8 +121,10 @@ def create_app(config_name=None):
         }
 
     # Request/response logging
-    # GDPR logging
-    flask_app.before_request(gdpr_log_request)
+    # GDPR logging, only when its logger is enabled: the logging configuration
+    # is already set at this point, there is no need to verify it per request
+    if gdpr_logging_enabled():
+        flask_app.before_request(gdpr_log_request)
 
     # Debugging of requests and responses
     if flask_app.debug:
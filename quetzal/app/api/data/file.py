@@ -204,7 +204,7 @@ def delete(*, wid, uuid, user, token_info=None):
             # family: nothing to do for this family
             continue
 
-        elif latest.family.workspace is None:
+        elif latest.family.fk_workspace_id is None:
             # This file has some global (ie committed) metadata, it needs to
             # be cleared by creating a new metadata entry that will be empty
             # (only with its id)
@@ -293,7 +293,7 @@ def update_metadata(*, wid, uuid, body):
             logger.debug('There is no previous metadata, creating a new metadata entry')
             latest = Metadata(id_file=uuid, family=family, json={'id': uuid})
 
-        elif latest.family.workspace is None:
+        elif latest.family.fk_workspace_id is None:
             # This file has some global (ie committed) metadata
             logger.info('A previous metadata entry exists, copying metadata %s', latest)
             latest = latest.copy()
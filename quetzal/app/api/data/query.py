@@ -1,14 +1,16 @@
+import hashlib
 import logging
 
 from connexion import request
 from flask import current_app, url_for
 from requests import codes
 from psycopg2 import ProgrammingError
+from werkzeug.http import quote_etag
 import sqlparse
 
 from quetzal.app import db
 from quetzal.app.api.exceptions import APIException, ObjectNotFoundException
-from quetzal.app.helpers.pagination import paginate
+from quetzal.app.helpers.pagination import DEFAULT_PAGE, DEFAULT_PER_PAGE, paginate
 from quetzal.app.models import MetadataQuery, QueryDialect, Workspace
 from quetzal.app.security import (
     PublicReadPermission, PublicWritePermission,
@@ -18,6 +20,9 @@ from quetzal.app.security import (
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of prepared statements kept on each database connection
+_MAX_PREPARED_STATEMENTS = 256
+
 
 def create(*, body, user, token_info=None):
 
@@ -61,7 +66,10 @@ def fetch(*, user, token_info=None):
                            detail='You are not authorized to query global metadata')
 
     queries = MetadataQuery.query.filter(MetadataQuery.fk_workspace_id.is_(None))
-    pager = paginate(queries, serializer=MetadataQuery.to_dict)
+    # Clients that follow the cursor only need to know if there is a next
+    # page: do not count all the queries for them
+    pager = paginate(queries, serializer=MetadataQuery.to_dict, keyset_column=MetadataQuery.id,
+                     with_total='cursor' not in request.args)
 
     return pager.response_object(), codes.ok
 
@@ -74,27 +82,18 @@ def details(*, qid, user, token_info=None):
                            detail='You are not authorized to query global metadata')
     query = MetadataQuery.get_or_404(qid)
 
-    # TODO: check if global_views schema exists!
-    engine = db.get_engine(app=current_app, bind='read_only_bind')
-    conn = engine.raw_connection()
-    with conn.cursor() as cursor:
-        cursor.execute(f'SET SEARCH_PATH TO global_views_{query.dialect.value}')
-        try:
-            cursor.execute(query.code)
-        except ProgrammingError as ex:
-            # Log bad permission errors with warning; the user may be trying something fishy
-            if ex.pgcode == '42501':
-                logger.warning('User query failed due to permissions. Query %s was: %s',
-                               query, query.code, exc_info=ex)
-            else:
-                logger.info('User query failed', exc_info=ex)
-            raise APIException(status=codes.bad_request,
-                               title='Query failed',
-                               detail=f'Query could not be executed due to error:\n{ex!s}')
+    # The global views are only changed by recreating their tables: the
+    # results cannot have changed if the client already has a response for
+    # the same tables
+    schema_name = f'global_views_{query.dialect.value}'
+    version = _global_views_version(schema_name)
+    etag = _query_etag(query, version)
+    if etag in request.if_none_match:
+        return None, codes.not_modified, {'ETag': quote_etag(etag)}
 
-        pager = paginate(cursor)
-        response = query.to_dict(pager.response_object())
-        return response, codes.ok
+    # TODO: check if global_views schema exists!
+    response = _run_query(schema_name, query, version)
+    return response, codes.ok, {'ETag': quote_etag(etag)}
 
 
 def fetch_w(*, wid, user, token_info=None):
@@ -106,7 +105,8 @@ def fetch_w(*, wid, user, token_info=None):
                            title='Forbidden',
                            detail='You are not authorized to query this workspace')
 
-    pager = paginate(workspace.queries, serializer=MetadataQuery.to_dict)
+    pager = paginate(workspace.queries, serializer=MetadataQuery.to_dict, keyset_column=MetadataQuery.id,
+                     with_total='cursor' not in request.args)
 
     return pager.response_object(), codes.ok
 
@@ -157,7 +157,7 @@ def details_w(*, wid, qid, user, token_info=None):
                            detail='You are not authorized to query this workspace')
 
     query = MetadataQuery.get_or_404(qid)
-    if query.workspace != workspace:
+    if query.fk_workspace_id != workspace.id:
         raise ObjectNotFoundException(status=codes.not_found,
                                       title='Not found',
                                       detail=f'MetadataQuery {qid} was not found on workspace {wid}')
@@ -167,12 +167,47 @@ def details_w(*, wid, qid, user, token_info=None):
                            title='Cannot query an unscanned workspace',
                            detail='Queries need a workspace that has been correctly scanned')
 
+    # Each scan creates a new schema name, which serves as the version of the
+    # workspace views
+    etag = _query_etag(query, workspace.pg_schema_name)
+    if etag in request.if_none_match:
+        return None, codes.not_modified, {'ETag': quote_etag(etag)}
+
+    response = _run_query(f'{workspace.pg_schema_name}_{query.dialect.value}', query)
+    return response, codes.ok, {'ETag': quote_etag(etag)}
+
+
+def _run_query(schema_name, query, version=None):
+    """Execute a query on the views of a schema and paginate its results
+
+    Parameters
+    ----------
+    schema_name: str
+        Name of the schema where the query will be executed.
+    query: quetzal.app.models.MetadataQuery
+        Query to execute.
+    version: object, optional
+        Version of the schema contents, used to avoid reusing a prepared
+        statement on a schema that has been recreated under the same name.
+
+    Returns
+    -------
+    dict
+        Query details with the paginated results, as in
+        :py:meth:`quetzal.app.models.MetadataQuery.to_dict`.
+
+    Raises
+    ------
+    quetzal.app.api.exceptions.APIException
+        When the query fails.
+
+    """
     engine = db.get_engine(app=current_app, bind='read_only_bind')
     conn = engine.raw_connection()
     with conn.cursor() as cursor:
-        cursor.execute(f'SET SEARCH_PATH TO {workspace.pg_schema_name}_{query.dialect.value}')
+        cursor.execute(f'SET SEARCH_PATH TO {schema_name}')
         try:
-            cursor.execute(query.code)
+            _execute_prepared(conn, cursor, query.code, f'{schema_name}:{version}')
         except ProgrammingError as ex:
             # Log bad permission errors with warning; the user may be trying something fishy
             if ex.pgcode == '42501':
@@ -185,7 +220,69 @@ def details_w(*, wid, qid, user, token_info=None):
                                detail=f'Query could not be executed due to error:\n{ex!s}')
 
         pager = paginate(cursor)
-        response = query.to_dict(pager.response_object())
-        return response, codes.ok
-
-
+        return query.to_dict(pager.response_object())
+
+
+def _execute_prepared(conn, cursor, code, key):
+    """Execute some SQL code through a prepared statement
+
+    Prepared statements only exist on the database session where they were
+    created. The names of the statements prepared on each connection are
+    kept on the connection ``info`` dictionary, which lives as long as the
+    underlying DBAPI connection, even when it goes back to the pool. This
+    way, a repeated query skips the parse and plan phases.
+
+    Only code with a single ``SELECT`` statement is prepared; anything else
+    is executed directly.
+    """
+    statements = sqlparse.parse(code)
+    if len(statements) != 1 or statements[0].get_type() != 'SELECT':
+        cursor.execute(code)
+        return
+
+    digest = hashlib.blake2b(f'{key}:{code}'.encode(), digest_size=8).hexdigest()
+    name = f'stmt_{digest}'
+    prepared = conn.info.setdefault('quetzal_prepared_statements', set())
+    if name not in prepared:
+        # Do not let old statements (from schemas that no longer exist)
+        # accumulate indefinitely on long-lived connections
+        if len(prepared) >= _MAX_PREPARED_STATEMENTS:
+            cursor.execute('DEALLOCATE ALL')
+            prepared.clear()
+        statement = str(statements[0]).strip().rstrip(';')
+        cursor.execute(f'PREPARE {name} AS {statement}')
+        prepared.add(name)
+    cursor.execute(f'EXECUTE {name}')
+
+
+def _global_views_version(schema_name):
+    """Get a value that changes every time the global views are updated
+
+    The global views are updated by dropping and creating their tables (or
+    their whole schema) again, which gives them new object identifiers. The
+    list of identifiers of the tables in the schema is therefore a cheap
+    version number of these views. Note that the global metadata is not a
+    good version number: the views are updated by a separate task, some time
+    after the metadata changes.
+    """
+    return db.session.execute(
+        "SELECT string_agg(c.oid::text, ',' ORDER BY c.oid) "
+        'FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace '
+        'WHERE n.nspname = :name',
+        {'name': schema_name}
+    ).scalar()
+
+
+def _query_etag(query, schema_version):
+    """Create a strong entity tag for a page of query results
+
+    The results of a query only depend on the query code (a query is never
+    modified once created), the version of the views where it is executed
+    and the requested page.
+    """
+    # Use the same defaults as the pagination, so that an explicit default
+    # value gives the same entity tag
+    page = request.args.get('page', DEFAULT_PAGE, type=int)
+    per_page = request.args.get('per_page', DEFAULT_PER_PAGE, type=int)
+    key = f'{query.id}:{schema_version}:{page}:{per_page}'
+    return hashlib.blake2b(key.encode(), digest_size=12).hexdigest()
@@ -37,7 +37,8 @@ def upload(filename, content, location):
         When the location is the global data bucket. This is not permitted.
 
     """
-    logger.debug('Saving GCP file %s at %s', filename, location)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Saving GCP file %s at %s', filename, location)
 
     # Verification that the upload does not change the global data directory
     data_bucket_url = current_app.config['QUETZAL_GCP_DATA_BUCKET']
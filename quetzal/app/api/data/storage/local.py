@@ -38,7 +38,8 @@ def upload(filename, content, location):
         When the location is the global data directory. This is not permitted.
 
     """
-    logger.debug('Saving local file %s at %s', filename, location)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Saving local file %s at %s', filename, location)
 
     # Verification that the upload does not change the global data directory
     data_dir = pathlib.Path(current_app.config['QUETZAL_FILE_DATA_DIR']).resolve()
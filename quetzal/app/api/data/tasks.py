@@ -1,28 +1,57 @@
-import copy
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+import fcntl
 import itertools
 import logging
+import os
 import pathlib
+import random
 import shutil
+import tempfile
 from urllib.parse import urlparse
 
 from flask import current_app
-from sqlalchemy import func, types
-from sqlalchemy.sql.ddl import CreateSchema
-from sqlalchemy.sql import literal
+from psycopg2 import OperationalError
+from sqlalchemy import distinct, func, select, text, tuple_, types
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql.ddl import CreateSchema, DDLElement
+from sqlalchemy.sql import column, literal, table
 from sqlalchemy.sql.functions import coalesce
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import JSONB, UUID
+from sqlalchemy.exc import SQLAlchemyError
 
 from quetzal.app import celery, db
-from quetzal.app.api.exceptions import Conflict, EmptyCommit, WorkerException
+from quetzal.app.api.exceptions import CommitFilesException, Conflict, EmptyCommit, WorkerException
 from quetzal.app.helpers.google_api import get_client, get_bucket, get_data_bucket
-from quetzal.app.helpers.sql import CreateTableAs, DropSchemaIfExists, GrantUsageOnSchema
+from quetzal.app.helpers.sql import (
+    Analyze, CreateIndexOn, CreateTableAs, DropSchemaIfExists, DropTableIfExists, GrantUsageOnSchema
+)
 from quetzal.app.models import Family, FileState, Metadata, QueryDialect, Workspace, WorkspaceState
 
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of files copied concurrently during a commit
+_COMMIT_MAX_WORKERS = 16
+# Number of rows fetched at a time when reading the files to commit
+_COMMIT_YIELD_PER = 256
 
-@celery.task(bind=True, max_retries=10)
+# Linux ioctl request to clone a file (reflink), see ioctl_ficlone(2)
+_FICLONE = 0x40049409
+
+# Number of blobs per deletion batch request (100 is the maximum of GCP) and
+# maximum number of concurrent requests when deleting the contents of a bucket,
+# with at most a window of chunks waiting to be deleted
+_DELETE_CHUNK_SIZE = 100
+_DELETE_MAX_WORKERS = 8
+_DELETE_MAX_IN_FLIGHT = 2 * _DELETE_MAX_WORKERS
+
+# Keys of the advisory locks that serialize the workspace commits and the
+# updates of the global views
+_COMMIT_LOCK_ID = 0x636f6d6d  # 'comm'
+_GLOBAL_VIEWS_LOCK_ID = 0x71756574  # 'quet'
+
+
+@celery.task(bind=True, max_retries=10, acks_late=True)
 def wait_for_workspace(self, wid):
     """ Wait until a workspace is created on the database
 
@@ -39,8 +68,12 @@ def wait_for_workspace(self, wid):
 
     workspace = Workspace.query.get(wid)
     if workspace is None:
-        logger.info('Workspace is not available yet')
-        raise self.retry(countdown=1)
+        # Retry with an exponential backoff: short delays are detected quickly,
+        # while long ones do not poll the database every second. The jitter
+        # avoids that many waiting tasks poll the database at the same time
+        countdown = min(2 ** self.request.retries, 60) + random.uniform(0, 1)
+        logger.info('Workspace is not available yet, retrying in %.1f seconds', countdown)
+        raise self.retry(countdown=countdown)
 
     logger.info('Workspace %s is now available', wid)
 
@@ -68,49 +101,114 @@ def init_workspace(wid):
     None
 
     """
-    logger.info('Initializing workspace %s...', wid)
+    workspace = _get_initializing_workspace(wid)
+    _init_workspace(workspace)
 
-    # Get the workspace object and verify preconditions
-    workspace = Workspace.query.get(wid)
+    # Commit changes to database
+    db.session.commit()
+
+
+@celery.task()
+def init_data_bucket(wid):
+    """ Initialize the data bucket of a workspace
+
+    Parameters
+    ----------
+    wid: int
+        Workspace identifier
+
+    Returns
+    -------
+    None
+
+    """
+    workspace = _get_initializing_workspace(wid)
+    _init_data_bucket(workspace)
+
+    # Commit changes to database
+    db.session.commit()
+
+
+@celery.task()
+def init_workspace_and_bucket(wid):
+    """ Initialize the internal representation and data bucket of a workspace
+
+    This task performs the same operations as :py:func:`init_workspace`
+    followed by :py:func:`init_data_bucket`, but it retrieves the workspace
+    only once and saves all changes in a single database transaction.
+
+    Parameters
+    ----------
+    wid: int
+        Workspace identifier
+
+    Returns
+    -------
+    None
+
+    """
+    workspace = _get_initializing_workspace(wid)
+    _init_workspace(workspace)
+    _init_data_bucket(workspace)
+
+    # Commit changes to database
+    db.session.commit()
+
+
+def _get_initializing_workspace(wid):
+    # Get the workspace object and verify preconditions.
+    # The owner is needed for the bucket name, load it in the same query
+    workspace = Workspace.query.options(joinedload(Workspace.owner)).get(wid)
     if workspace is None:
         raise WorkerException('Workspace was not found')
 
     if workspace.state != WorkspaceState.INITIALIZING:
         raise WorkerException('Workspace was not on the expected state')
 
+    return workspace
+
+
+def _init_workspace(workspace):
+    logger.info('Initializing workspace %s...', workspace.id)
+
     # Determine the most recent "global" metadata entry so that the workspace
     # has a reference number from which any new metadata will be ignored
     # TODO: needs to consider the version!
-    latest_metadata = (
-        db.session.query(Metadata)
-        .join(Family)
-        .filter_by(workspace=None)
-        .order_by(Metadata.id.desc())
-        .first()
-    )
-    logger.info('The latest global metadata is %s', latest_metadata)
-    if latest_metadata is None:
-        workspace.fk_last_metadata_id = None
-    else:
-        workspace.fk_last_metadata_id = latest_metadata.id
+    latest_metadata_id = Metadata.get_latest_global_id()
+    logger.info('The latest global metadata is %s', latest_metadata_id)
+    workspace.fk_last_metadata_id = latest_metadata_id
 
     # Verify and update family versions so that :
     # - non null version values are verified to exist
     # - null version values are set to the latest available version
+    families = workspace.families.all()
+
+    # Determine, in a single query, the latest version of the global families
+    # (i.e. with null workspace) that have been requested without version.
+    # This is grouped by family name in order to get the latest per family name
+    latest_names = {f.name for f in families if f.version is None}
+    latest_versions = {}
+    if latest_names:
+        latest_versions = dict(
+            db.session.query(Family.name, Family.version)
+            .filter(Family.fk_workspace_id.is_(None),
+                    Family.name.in_(latest_names))
+            .distinct(Family.name)
+            .order_by(Family.name, Family.version.desc())
+        )
 
-    # query that obtains the latest global family (i.e. with null workspace)
-    qs_global_families = (
-        Family.query
-        .filter_by(workspace=None)
-    )
-    # this is grouped by family name in order to get the latest per family name
-    qs_latest_families = (
-        qs_global_families
-        .distinct(Family.name, Family.version)
-        .order_by(Family.name, Family.version.desc())
-    )
+    # Determine, in a single query, which of the requested name and version
+    # combinations exist as a global family
+    requested_pairs = {(f.name, f.version) for f in families if f.version not in (None, 0)}
+    existing_pairs = set()
+    if requested_pairs:
+        existing_pairs = set(
+            db.session.query(Family.name, Family.version)
+            .filter(Family.fk_workspace_id.is_(None),
+                    tuple_(Family.name, Family.version).in_(requested_pairs))
+        )
 
-    for family in workspace.families:
+    for family in families:
         if family.version == 0:
             # Setting the family version to zero is permitted and does not need
             # any verification; it means that the workspace will not use any
@@ -122,12 +220,7 @@ def init_workspace(wid):
             # First, we need to verify that the name and version combination
             # does exist as a global family (i.e. a family that has been
             # commited and therefore has workspace == null)
-            exact_family = (
-                qs_global_families
-                .filter_by(name=family.name, version=family.version)
-                .one_or_none()
-            )
-            if exact_family is None:
+            if (family.name, family.version) not in existing_pairs:
                 # The specified version does not exist. Abort and set the
                 # workspace in an error state
                 logger.info('Family %s at version %s does not exist', family.name, family.version)
@@ -141,13 +234,9 @@ def init_workspace(wid):
             logger.info('Adding family %s at version %s', family.name, family.version)
 
         else:
-            latest_family = qs_latest_families.filter_by(name=family.name).first()
-            if latest_family is None:
-                # Family does not exist
-                family.version = 0
-            else:
-                # Family does exist, use the latest version
-                family.version = latest_family.version
+            # Use the latest version when the family exists, otherwise the
+            # family is new and its version is zero
+            family.version = latest_versions.get(family.name, 0)
 
             logger.info('Family %s at latest version set to version=%d',
                         family.name, family.version)
@@ -155,22 +244,10 @@ def init_workspace(wid):
             # save the family with the updated version number
             db.session.add(family)
 
-    # Commit changes to database
-    db.session.commit()
-
 
-@celery.task()
-def init_data_bucket(wid):
+def _init_data_bucket(workspace):
     storage_backend = current_app.config['QUETZAL_DATA_STORAGE']
-    logger.info('Initializing bucket of workspace %s on backend %s...', wid, storage_backend)
-
-    # Get the workspace object and verify preconditions
-    workspace = Workspace.query.get(wid)
-    if workspace is None:
-        raise WorkerException('Workspace was not found')
-
-    if workspace.state != WorkspaceState.INITIALIZING:
-        raise WorkerException('Workspace was not on the expected state')
+    logger.info('Initializing bucket of workspace %s on backend %s...', workspace.id, storage_backend)
 
     # Do the initialization task
     parts = ['ws', str(workspace.id), workspace.owner.username, workspace.name]
@@ -199,7 +276,6 @@ def init_data_bucket(wid):
     workspace.state = WorkspaceState.READY
     workspace.data_url = data_url
     db.session.add(workspace)
-    db.session.commit()
 
 
 def _init_gcp_data_bucket(bucket_name):
@@ -274,14 +350,46 @@ def _delete_gcp_data_bucket(url):
     client = get_client()
     bucket = get_bucket(url, client=client)
 
-    # Delete all blobs first
-    blobs = list(bucket.list_blobs())
-    bucket.delete_blobs(blobs)  # TODO: use the on_error for missing blobs
+    # Delete all blobs first. The listing is consumed page by page while the
+    # blobs are deleted concurrently in chunks, each chunk in a single batch
+    # request. Only a window of chunks is kept in flight, so that neither the
+    # listing nor the pending futures of a large bucket are held in memory
+    blobs = bucket.list_blobs(page_size=1000)
+    with ThreadPoolExecutor(max_workers=_DELETE_MAX_WORKERS) as executor:
+        pending = set()
+        for chunk in _chunks(blobs, _DELETE_CHUNK_SIZE):
+            if len(pending) >= _DELETE_MAX_IN_FLIGHT:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                # Propagate any error of the deletions
+                for future in done:
+                    future.result()
+            pending.add(executor.submit(_delete_gcp_blobs, bucket, chunk, client))
+        for future in pending:
+            future.result()
 
     # Delete the bucket
     bucket.delete()
 
 
+def _delete_gcp_blobs(bucket, blobs, client):
+    """Delete several blobs of a bucket with a single batch request"""
+    # The batch of a client is thread-local, so each thread can send its own.
+    # All deletions are sent together when the batch context exits
+    # TODO: use the on_error for missing blobs
+    with client.batch():
+        for blob in blobs:
+            bucket.delete_blob(blob.name, client=client)
+
+
+def _chunks(iterable, size):
+    """Split an iterable in lists of at most `size` elements"""
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
 def _delete_local_data_bucket(url):
     data_bucket = current_app.config['QUETZAL_FILE_DATA_DIR']
     if url.startswith(data_bucket):
@@ -302,8 +410,10 @@ def scan_workspace(wid):
         raise WorkerException('Workspace was not on the expected state')
 
     schema_name = workspace.make_schema_name()
-    _scan_create_table_views(workspace, schema_name)
-    _scan_create_json_views(workspace, schema_name)
+    # Load the family names once, both views need them
+    family_names = _family_names(workspace.families)
+    _scan_create_table_views(workspace, schema_name, family_names)
+    _scan_create_json_views(workspace, schema_name, family_names)
 
     # Update the workspace object to have the correct schema and state
     workspace.pg_schema_name = schema_name
@@ -325,7 +435,7 @@ def _new_schema(workspace, name, suffix):
     return new_name
 
 
-def _scan_create_json_views(workspace, schema_name):
+def _scan_create_json_views(workspace, schema_name, family_names=None):
     logger.info('Scanning workspace %s to create json views...', workspace.id)
 
     # The scanning task consists on the following procedure:
@@ -344,46 +454,57 @@ def _scan_create_json_views(workspace, schema_name):
     new_schema = _new_schema(workspace, schema_name, suffix)
 
     # Extract metadata per family
-    master_query = _make_json_view_query(workspace.get_metadata(), workspace.families)
+    if family_names is None:
+        family_names = _family_names(workspace.families)
+    master_query = _make_json_view_query(workspace.get_metadata(family_names), family_names)
 
     family_table_name = f'{new_schema}.metadata'
     create_table_statement = CreateTableAs(family_table_name, master_query)
     db.session.execute(create_table_statement)
+    _index_and_analyze(family_table_name)
 
     # Set permissions on readonly user to the schema contents
     db.session.execute(GrantUsageOnSchema(new_schema, 'db_ro_user'))
 
 
-def _make_json_view_query(metadata_query, families):
-    subqueries = []
-    sorted_families = sorted(families,
-                             key=lambda fam: (-1, fam.name) if fam.name == 'base' else (+1, fam.name))
-    for family in sorted_families:
-        sub = (
-            metadata_query
-            .filter(Family.name == family.name)
-            .with_entities(Metadata.id_file.label('metadata_id_file'),
-                           Metadata.json.label('metadata_json'))
-            .subquery(name=family.name)
-        )
-        subqueries.append(sub)
-
-    # Make a joined table of all metadata and set the json column to the name of the family
-    qbase = subqueries.pop(0)  # the first one is always the base family, due to the sort done before
-    joined_query = db.session.query(qbase)
-    columns = [qbase.c.metadata_id_file.label('id'), qbase.c.metadata_json.label('base')]
-    for q in subqueries:
-        joined_query = joined_query.outerjoin((q, qbase.c.metadata_id_file == q.c.metadata_id_file))
+def _make_json_view_query(metadata_query, family_names):
+    # Aggregate the metadata of each file in a single json object, keyed by
+    # family name. This needs a single pass over the metadata, instead of
+    # one subquery per family joined together
+    tmp = (
+        metadata_query
+        .with_entities(Metadata.id_file.label('id_file'),
+                       Family.name.label('family_name'),
+                       Metadata.json.label('json'))
+        .subquery()
+    )
+    aggregated = (
+        db.session.query(tmp.c.id_file,
+                         func.jsonb_object_agg(tmp.c.family_name, tmp.c.json, type_=JSONB).label('families'))
+        .group_by(tmp.c.id_file)
+        .subquery()
+    )
+
+    # Split the aggregated object in one column per family, named as the
+    # family. The base family always comes first
+    columns = [aggregated.c.id_file.label('id'), aggregated.c.families['base'].label('base')]
+    for name in sorted(set(family_names) - {'base'}):
         # Here, we are coalescing to set an empty dict to files that do not
         # have an entry for this particular family. This does not apply to the
         # base family because the base family is always present
-        columns.append(coalesce(q.c.metadata_json, literal({}, types.JSON)).label(q.name))
-
-    master_query = joined_query.with_entities(*columns).subquery()
+        columns.append(coalesce(aggregated.c.families[name], literal({}, JSONB)).label(name))
+
+    master_query = (
+        db.session.query(*columns)
+        # Only files with base metadata, as when the base family was the
+        # left side of the joins
+        .filter(aggregated.c.families.has_key('base'))
+        .subquery()
+    )
     return master_query
 
 
-def _scan_create_table_views(workspace, schema_name):
+def _scan_create_table_views(workspace, schema_name, family_names=None):
     logger.info('Scanning workspace %s to create table views...', workspace.id)
 
     # The scanning task consists on the following procedure:
@@ -402,47 +523,157 @@ def _scan_create_table_views(workspace, schema_name):
     suffix = f'_{QueryDialect.POSTGRESQL.value}'
     new_schema = _new_schema(workspace, schema_name, suffix)
 
-    # 2. For each family
-    workspace_metadata = workspace.get_metadata()
-    for family in workspace.families.all():
-
-        tmp = workspace_metadata.filter(Family.name == family.name).subquery()
-        keys_query = db.session.query(func.jsonb_object_keys(tmp.c.metadata_json)).distinct()
-        keys = set(res[0] for res in keys_query.all()) - {'id'}
-        logger.info('Keys for family %s are %s', family.name, keys)
-
-        # 2.1 Determine the type of all columns
-        # TODO consider this, for the moment, everything is a string
-        types_schema = {}
-        if family.name == 'base':  # TODO refactor base schema to an external variable
-            types_schema['size'] = types.BigInteger
-            types_schema['date'] = types.DateTime(timezone=True)
-
-        # 2.2 Create table
-        columns = [Metadata.json['id'].astext.cast(UUID).label('id')]
-        for k in keys:
-            col_k = Metadata.json[k].astext  # TODO: do we need to protect the key names from injection?
-            if k in types_schema:
-                col_k = col_k.cast(types_schema[k])
-            columns.append(col_k.label(k))
+    # 2. and 3. Create the tables of each family
+    if family_names is None:
+        family_names = _family_names(workspace.families)
+    statements = _family_tables_statements(workspace.get_metadata(family_names), family_names, new_schema)
+
+    # Set permissions on readonly user to the schema contents
+    statements.append(GrantUsageOnSchema(new_schema, 'db_ro_user'))
 
+    # Send all the statements in a single round-trip
+    _execute_all(statements)
+
+
+def _family_tables_statements(metadata_query, family_names, schema_name):
+    """Prepare the statements that create one table per family
+
+    Each table has a column per metadata key of its family. The statements
+    are returned rather than executed, so that callers can send them to the
+    database in a single round-trip with :py:func:`_execute_all`.
+
+    Parameters
+    ----------
+    metadata_query: sqlalchemy.orm.query.Query
+        Query on the metadata entries to put in the tables, such as
+        :py:meth:`Workspace.get_metadata` or :py:meth:`Metadata.get_latest_global`.
+    family_names: iterable
+        Names of the families whose table will be created. Families without
+        any metadata get a table with only an id column.
+    schema_name: str
+        Schema where the tables are created.
+
+    Returns
+    -------
+    list
+        The statements to execute, in the current transaction.
+
+    """
+    # Materialize the metadata once in a temporary table, so that it is not
+    # computed again for each family. The table is dropped automatically at
+    # the end of the transaction, the family tables must be created before
+    tmp_name = f'{schema_name}_tmp'
+    _execute_all([
+        CreateTableAs(tmp_name,
+                      metadata_query
+                      .with_entities(Family.name.label('family_name'), Metadata.json.label('json'))
+                      .subquery(),
+                      temporary=True),
+        CreateIndexOn(tmp_name, 'family_name'),
+        Analyze(tmp_name),
+    ])
+    tmp = table(tmp_name, column('family_name'), column('json', JSONB))
+
+    # Get the keys of all families in a single query instead of one query
+    # per family
+    all_keys = (
+        db.session.query(tmp.c.family_name, func.jsonb_object_keys(tmp.c.json).label('key'))
+        .subquery()
+    )
+    # The id key is always the first column, it is excluded here and the
+    # keys are aggregated in one array per family
+    keys_query = (
+        db.session.query(all_keys.c.family_name, func.array_agg(distinct(all_keys.c.key)))
+        .filter(all_keys.c.key != 'id')
+        .group_by(all_keys.c.family_name)
+    )
+    keys_by_family = dict(keys_query.all())
+
+    statements = []
+    for family_name in family_names:
+        keys = keys_by_family.get(family_name, [])
+        logger.info('Keys for family %s are %s', family_name, keys)
+
+        # Create table
         create_table_query = (
-            workspace_metadata.filter(Family.name == family.name,
-                                      Metadata.json['state'].astext != 'DELETED' if family.name == 'base' else True)
-            .with_entities(*columns)
-            .subquery()
+            select(_family_columns(tmp.c.json, family_name, keys))
+            .where(tmp.c.family_name == family_name)
+            .where(tmp.c.json['state'].astext != 'DELETED' if family_name == 'base' else True)
         )
-        family_table_name = f'{new_schema}.{family.name}'
-        create_table_statement = CreateTableAs(family_table_name, create_table_query)
-        db.session.execute(create_table_statement)
+        family_table_name = f'{schema_name}.{family_name}'
+        statements.append(CreateTableAs(family_table_name, create_table_query))
 
-        # TODO: create an index on the id column
+        # Create an index on the id column for efficient joins and refresh
+        # the planner statistics of the new table
+        statements.append(CreateIndexOn(family_table_name, 'id'))
+        if family_name == 'base' and 'state' in keys:
+            # Queries on the base family often filter on the file state
+            statements.append(CreateIndexOn(family_table_name, 'state'))
+        statements.append(Analyze(family_table_name))
 
-    # Set permissions on readonly user to the schema contents
-    db.session.execute(GrantUsageOnSchema(new_schema, 'db_ro_user'))
+    return statements
 
 
-@celery.task()
+def _family_names(family_query):
+    """Get the names of the families of a query, without loading the families"""
+    return [name for name, in family_query.with_entities(Family.name)]
+
+
+def _family_columns(json_column, family_name, keys):
+    """Build the columns of a family table from a json metadata column"""
+    # Determine the type of all columns
+    # TODO consider this, for the moment, everything is a string
+    types_schema = {}
+    if family_name == 'base':  # TODO refactor base schema to an external variable
+        types_schema['size'] = types.BigInteger
+        types_schema['date'] = types.DateTime(timezone=True)
+
+    columns = [json_column['id'].astext.cast(UUID).label('id')]
+    for k in keys:
+        col_k = json_column[k].astext  # TODO: do we need to protect the key names from injection?
+        if k in types_schema:
+            col_k = col_k.cast(types_schema[k])
+        columns.append(col_k.label(k))
+    return columns
+
+
+def _index_and_analyze(table_name):
+    """Index the id column of a view table and update its statistics
+
+    Queries on the views join the tables on their id column, so an index
+    there and fresh planner statistics avoid hash joins on cold tables.
+    The index is created without ``CONCURRENTLY`` because the table was
+    created in the current transaction and nobody else can see it yet.
+    """
+    db.session.execute(CreateIndexOn(table_name, 'id'))
+    db.session.execute(Analyze(table_name))
+
+
+def _execute_all(statements):
+    """Execute several statements in a single round-trip to the database
+
+    The statements are compiled with their parameters rendered inline and
+    sent together as one multi-statement string, which runs inside the
+    current transaction of the session.
+    """
+    if not statements:
+        return
+    connection = db.session.connection()
+    sql = ';\n'.join(_compile_inline(statement, connection.dialect).rstrip(';')
+                      for statement in statements)
+    connection.execute(sql)
+
+
+def _compile_inline(statement, dialect):
+    """Compile a statement to a string with its parameters rendered inline"""
+    if isinstance(statement, DDLElement):
+        # DDL statements have no parameters, and their compiler does not
+        # accept the literal_binds argument
+        return str(statement.compile(dialect=dialect))
+    return str(statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+
+
+@celery.task(acks_late=True)
 def commit_workspace(wid):
     logger.info('Committing workspace %s...', wid)
 
@@ -454,15 +685,25 @@ def commit_workspace(wid):
     if workspace.state != WorkspaceState.COMMITTING:
         raise WorkerException('Workspace was not on the expected state')
 
-    db.session.begin_nested()  # make a savepoint
+    # The commit is done in two phases so that the commit lock is not held
+    # while the files are copied, which can take a long time:
+    # 1. Copy the new files to the data directory. This does not need any
+    #    lock: the workspace is in COMMITTING state, so its files cannot
+    #    change in the meantime.
+    # 2. Take the commit lock and do all the database changes.
+    # If the second phase fails, the files created by the first phase are
+    # deleted. Files that were already on the global data directory (such as
+    # committed files whose metadata changed) are never deleted.
+    new_urls = []
+    created_urls = []
     try:
-        # Lock the database so that nothing gets written or read on the database
-        db.session.execute(f'LOCK TABLE {Metadata.__table__.name} IN ACCESS EXCLUSIVE MODE;')
+        # Load the families once, they are needed several times below
+        families = workspace.families.all()
+        base_family = _get_base_family(families)
 
-        # Verify conflicts, raise Conflict if there is any conflict
-        _conflict_detection(workspace)
-
-        base_family = workspace.get_base_family()
+        # Verify conflicts early, before copying anything. This is verified
+        # again later, once the commit lock is taken
+        _conflict_detection(workspace, families)
 
         # Move new READY files (not temporary and not deleted) to the data
         # directory. Since creating a new file creates a new base metadata
@@ -473,108 +714,206 @@ def commit_workspace(wid):
             base_family.metadata_set
             .filter(Metadata.json['state'].astext == FileState.READY.name)
         )
-        files_deleted = (
-            base_family.metadata_set
-            .filter(Metadata.json['state'].astext == FileState.DELETED.name)
+
+        # Count the ready and deleted files in a single query
+        num_ready, num_deleted = (
+            db.session.query(
+                func.count(Metadata.id).filter(Metadata.json['state'].astext == FileState.READY.name),
+                func.count(Metadata.id).filter(Metadata.json['state'].astext == FileState.DELETED.name),
+            )
+            .filter(Metadata.fk_family_id == base_family.id)
+            .one()
         )
+        if num_ready + num_deleted == 0:
+            raise EmptyCommit
+        logger.info('There are %d files to commit', num_ready + num_deleted)
+
+        # Stream the files from a server-side cursor, so that the copies
+        # start as soon as the first rows arrive. Only the needed columns are
+        # read, there is no need to keep Metadata objects in the session
+        files = (
+            files_ready
+            .with_entities(Metadata.id, Metadata.json['id'].astext, Metadata.json['url'].astext)
+            .execution_options(stream_results=True)
+            .yield_per(_COMMIT_YIELD_PER)
+        )
+        metadata_ids = []
+
+        def _files_to_copy():
+            for metadata_id, file_id, file_url in files:
+                logger.info('Commit: copying %s (%s) to data directory', file_id, file_url)
+                metadata_ids.append(metadata_id)
+                yield file_id, file_url
+
+        new_urls, created_urls = _commit_files(_files_to_copy())
+
+        # Terminate the current transaction, so that it does not keep any
+        # lock while waiting for the commit lock below
+        db.session.commit()
+
+    except Conflict:
+        logger.info('Commit failed due to conflict', exc_info=True)
+        db.session.rollback()
+        workspace.state = WorkspaceState.CONFLICT
+        db.session.add(workspace)
+        db.session.commit()
+        return
+
+    except EmptyCommit:
+        logger.info('Empty commit, nothing to do')
+        db.session.rollback()
+        workspace.state = WorkspaceState.READY
+        db.session.add(workspace)
+        db.session.commit()
+        return
+
+    except CommitFilesException as ex:
+        logger.info('Could not copy the files of the commit, workspace will '
+                    'remain in COMMITTING state', exc_info=True)
+        db.session.rollback()
+        _uncommit_files(ex.urls)
+        return
+
+    except:
+        logger.info('Unexpected error on workspace commit, workspace will '
+                    'remain in COMMITTING state', exc_info=True)
+        db.session.rollback()
+        _uncommit_files(created_urls)
+        return
+
+    committed = False
+    db.session.begin_nested()  # make a savepoint
+    try:
+        # Serialize the commits with a transaction-level advisory lock, so
+        # that the conflict detection and family version increments of two
+        # commits cannot interleave. Unlike a table lock, this does not
+        # block the readers and writers of the metadata table
+        db.session.execute(select([func.pg_advisory_xact_lock(_COMMIT_LOCK_ID)]))
+
+        # Load the families again, the previous objects expired with the
+        # commit of the first phase. Their rows are locked since they are
+        # going to be modified
+        families = workspace.families.with_for_update().all()
+        base_family = _get_base_family(families)
+
+        # Verify conflicts again, another workspace may have been committed
+        # while the files were copied. Raise Conflict if there is any conflict
+        _conflict_detection(workspace, families)
+
+        _update_metadata_urls(dict(zip(metadata_ids, new_urls)))
+
         files_not_ready = (
             base_family.metadata_set
             .filter(Metadata.json['state'].astext == FileState.TEMPORARY.name)
             .subquery()
         )
 
-        if files_ready.count() + files_deleted.count() == 0:
-            raise EmptyCommit
-        logger.info('There are %d files to commit', files_ready.count() + files_deleted.count())
-
-        for file_meta in files_ready:
-            logger.info('Commit: copying %s ( %s) to data directory',
-                        file_meta, file_meta.json['url'])
-            new_url = _commit_file(file_meta.json['id'], file_meta.json['url'])
-            file_meta.update({'url': new_url})
-            db.session.add(file_meta)
+        # Families that were never committed before have no table on the
+        # global views yet, even if they have no metadata
+        global_family_names = set(_family_names(
+            Family.query
+            .filter(Family.fk_workspace_id.is_(None),
+                    Family.name.in_([family.name for family in families]))
+            .distinct()
+        ))
+        new_family_names = {family.name for family in families} - global_family_names
 
         # Do the committing task:
         # Iterate over all families, but do base family last, because the
         # subquery above files_not_ready takes uses the base family to determine
         # which files are not ready
         families = itertools.chain(
-            workspace.families.filter(Family.name != 'base'),
+            (family for family in families if family.name != 'base'),
             [base_family]
         )
+        committed_family_ids = []
         for family in families:
             new_family = family.increment()
             family.version = new_family.version
             family.workspace = None
+            committed_family_ids.append(family.id)
             db.session.add_all([family, new_family])
+            db.session.flush()  # needed to get the new family id
 
             # All files that are TEMPORARY need to be associated with the
-            # family of this workspace, not the committed family
-            meta_not_ready = (
-                family.metadata_set
-                .join(files_not_ready, Metadata.id_file == files_not_ready.c.id_file)
+            # family of this workspace, not the committed family. This is
+            # done with a single UPDATE
+            num_not_ready = (
+                Metadata.query
+                .filter(Metadata.fk_family_id == family.id,
+                        Metadata.id_file.in_(db.session.query(files_not_ready.c.id_file)))
+                .update({Metadata.fk_family_id: new_family.id}, synchronize_session=False)
             )
-            logger.info('Meta that is not ready: %s', meta_not_ready.all())
-            for meta in meta_not_ready:
-                meta.family = new_family
-                db.session.add(meta)
+            logger.info('Moved %d metadata entries that are not ready to %s', num_not_ready, new_family)
+
+        # Only the families that have new metadata, or that are new, need a
+        # global view update
+        changed_family_names = sorted(new_family_names.union(_family_names(
+            Family.query
+            .filter(Family.id.in_(committed_family_ids))
+            .join(Metadata)
+            .distinct()
+        )))
 
         # update the fk_last_metadata_id:
         # Determine the most recent "global" metadata entry so that the workspace
         # has a reference number from which any new metadata will be ignored
         # TODO: needs to consider the version!
         # TODO: consider refactor into workspace model
-        latest_metadata = (
-            db.session.query(Metadata)
-            .join(Family)
-            .filter_by(workspace=None)
-            .order_by(Metadata.id.desc())
-            .first()
-        )
-        if latest_metadata is not None:
-            workspace.fk_last_metadata_id = latest_metadata.id
-        else:
-            workspace.fk_last_metadata_id = None
-
-        # Update the global views for public queries
-        _update_global_views()
+        workspace.fk_last_metadata_id = Metadata.get_latest_global_id()
 
         # Everything went ok!
         # TODO: consider if the schema (ie the postgres view) should be deleted?
         workspace.state = WorkspaceState.READY
         db.session.add(workspace)
         db.session.commit()
+        committed = True
 
     except Conflict:
         logger.info('Commit failed due to conflict', exc_info=True)
         db.session.rollback()  # revert to savepoint
+        # Only the files created by this commit are deleted, the files that
+        # were already committed are still used by the global metadata
+        _uncommit_files(created_urls)
         workspace.state = WorkspaceState.CONFLICT
         db.session.add(workspace)
 
-    except EmptyCommit:
-        logger.info('Empty commit, nothing to do')
-        db.session.rollback()  # revert to savepoint
-        workspace.state = WorkspaceState.READY
-        db.session.add(workspace)
-
     except:
         logger.info('Unexpected error on workspace commit, workspace will '
                     'remain in COMMITTING state', exc_info=True)
         db.session.rollback()  # revert to savepoint
+        _uncommit_files(created_urls)
 
     db.session.commit()
 
+    # Update the global views for public queries. This is done on a separate
+    # task, once the commit lock is released. If the update fails, all the
+    # views are recreated, the tables of the changed families are outdated.
+    # There is nothing to update when no family changed
+    if committed and changed_family_names:
+        update_global_views.apply_async((changed_family_names, ), link_error=rebuild_global_views.s())
+    elif committed:
+        logger.info('No family changed, the global views are up to date')
+
+
+def _get_base_family(families):
+    """Get the base family from a list of families of a workspace"""
+    return next(family for family in families if family.name == 'base')
+
 
-def _conflict_detection(workspace):
+def _conflict_detection(workspace, families=None):
+    if families is None:
+        families = workspace.families.all()
     # if the workspace families are the latest global families, then
-    # there is no conflict
+    # there is no conflict. Only the families of the workspace are needed
     latest_families = (
         db.session.query(Family.name, func.max(Family.version))
-        .filter(Family.fk_workspace_id.is_(None))
+        .filter(Family.fk_workspace_id.is_(None),
+                Family.name.in_([family.name for family in families]))
         .group_by(Family.name)
     )
     latest_families_dict = {k: v for k, v in latest_families}
-    for family in workspace.families:
+    for family in families:
         if family.name not in latest_families_dict:
             # It's a new family, not known in the global workspace
             continue
@@ -589,34 +928,218 @@ def _conflict_detection(workspace):
 
 
 
-def _commit_file(file_id, file_url):
+def _update_metadata_urls(urls):
+    """Change the url of several metadata entries with a single UPDATE
+
+    Parameters
+    ----------
+    urls: dict
+        New url of each metadata entry, indexed by the metadata id.
+
+    """
+    if not urls:
+        return
+    ids, new_urls = zip(*urls.items())
+    statement = text(
+        f'UPDATE {Metadata.__table__.name} '
+        f"SET json = jsonb_set(json, '{{url}}', to_jsonb(v.url)) "
+        f'FROM unnest(CAST(:ids AS integer[]), CAST(:urls AS text[])) AS v(id, url) '
+        f'WHERE {Metadata.__table__.name}.id = v.id'
+    )
+    db.session.execute(statement, {'ids': list(ids), 'urls': list(new_urls)})
+
+
+def _commit_files(files):
+    """Copy several files to the global data directory or bucket
+
+    The copies are done concurrently, since each one is mostly waiting for
+    the storage backend.
+
+    Parameters
+    ----------
+    files: iterable
+        Iterable of ``(file_id, file_url)`` tuples of the files to copy. The
+        copies are submitted while the iterable is consumed.
+
+    Returns
+    -------
+    urls: list
+        The new url of each file, in the same order as `files`.
+    created_urls: list
+        The urls of the files that did not exist before this copy. Only
+        these can be deleted if the commit fails.
+
+    Raises
+    ------
+    CommitFilesException
+        When any file could not be copied. The exception has the urls of
+        the files that were created anyway, so that they can be deleted.
+
+    """
+    app = current_app._get_current_object()
+    # Share a single GCP client instead of creating one per thread
+    client = get_client() if app.config['QUETZAL_DATA_STORAGE'] == 'GCP' else None
+
+    def _commit_file_in_context(args):
+        # The application context is thread-local: each thread needs its own
+        with app.app_context():
+            return _commit_file(*args, client=client)
+
+    futures = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=_COMMIT_MAX_WORKERS) as executor:
+        try:
+            for index, args in enumerate(files):
+                futures[executor.submit(_commit_file_in_context, args)] = index
+        except Exception as ex:
+            # Reading the files failed, but the copies already submitted
+            # still need to be collected
+            error = ex
+
+        # Collect every copy, even after a failure, so that the ones that
+        # succeeded are known and can be deleted
+        urls = [None] * len(futures)
+        created_urls = []
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                url, created = future.result()
+            except Exception as ex:
+                if error is None:
+                    error = ex
+                    # Do not start any other copy
+                    for pending in futures:
+                        pending.cancel()
+                continue
+            urls[futures[future]] = url
+            if created:
+                created_urls.append(url)
+
+    if error is not None:
+        raise CommitFilesException(f'Could not copy the files to commit: {error}', urls=created_urls) from error
+    return urls, created_urls
+
+
+def _uncommit_files(urls):
+    """Delete files that were copied to the data directory or bucket
+
+    This is used to revert :py:func:`_commit_files` when a commit fails.
+    Errors are logged but not raised, since this is only a cleanup.
+
+    Parameters
+    ----------
+    urls: list
+        List of urls of the files to delete. Only the urls created by
+        :py:func:`_commit_files` must be given here, never the url of a file
+        that existed before the commit.
+
+    """
+    if not urls:
+        return
+    logger.info('Deleting %d copied files of a failed commit', len(urls))
+    storage_backend = current_app.config['QUETZAL_DATA_STORAGE']
+    try:
+        if storage_backend == 'GCP':
+            data_bucket = get_data_bucket()
+            blob_names = [urlparse(url).path.lstrip('/') for url in urls]
+            data_bucket.delete_blobs(blob_names, on_error=lambda blob: None)
+        elif storage_backend == 'file':
+            for url in urls:
+                path = pathlib.Path(urlparse(url).path)
+                if path.exists():
+                    path.unlink()
+    except:
+        logger.warning('Could not delete copied files %s', urls, exc_info=True)
+
+
+def _commit_file(file_id, file_url, client=None):
+    """Copy a file to the global data directory or bucket
+
+    Returns
+    -------
+    url: str
+        The url of the file on the global data directory or bucket.
+    created: bool
+        Whether the file was created by this copy. It is ``False`` when the
+        file was already there, as when a committed file is committed again
+        because its metadata changed.
+
+    """
     # TODO: move to a file operations file, along with upload/download
     storage_backend = current_app.config['QUETZAL_DATA_STORAGE']
     if storage_backend == 'GCP':
-        return _commit_file_gcp(file_id, file_url)
+        return _commit_file_gcp(file_id, file_url, client=client)
     elif storage_backend == 'file':
         return _commit_file_local(file_id, file_url)
     raise ValueError(f'Unknown storage backend {storage_backend}')
 
 
 def _commit_file_local(file_id, file_url):
-    source_path = pathlib.Path(urlparse(file_url).path)
-    target_path = pathlib.Path(current_app.config['QUETZAL_FILE_DATA_DIR']) / file_id
-    shutil.copy(str(source_path.resolve()), str(target_path.resolve()))
-    return f'file://{target_path.resolve()}'
+    source_path = pathlib.Path(urlparse(file_url).path).resolve()
+    target_path = (pathlib.Path(current_app.config['QUETZAL_FILE_DATA_DIR']) / file_id).resolve()
+    created = not target_path.exists()
+    _copy_file(str(source_path), str(target_path))
+    return f'file://{target_path}', created
 
 
-def _commit_file_gcp(file_id, file_url):
+def _copy_file(source, target):
+    """Copy a file and its permissions, cloning its contents when possible
+
+    On filesystems that support it (btrfs, xfs, ...), the copy is a
+    copy-on-write clone that does not need to copy any data. Otherwise, the
+    contents are copied as in :py:func:`shutil.copy`. The contents are written
+    to a temporary file that replaces the target at the end, so the target is
+    never left truncated. Nothing is done when the source and target are the
+    same file, as when the metadata of a committed file was changed.
+
+    Note that a hard link would not be correct: the workspace file can be
+    overwritten in place by a new upload.
+    """
+    if os.path.exists(target) and os.path.samefile(source, target):
+        logger.info('File %s is already on the data directory', target)
+        return
+
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.tmp-')
+    try:
+        with open(source, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+                cloned = True
+            except OSError:
+                # Clones are not supported by the filesystem or the files are
+                # on different filesystems
+                cloned = False
+        if not cloned:
+            shutil.copyfile(source, temporary)
+        shutil.copymode(source, temporary)
+        os.replace(temporary, target)
+    except:
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        raise
+
+
+def _commit_file_gcp(file_id, file_url, client=None):
     file_url_parsed = urlparse(file_url)
-    data_bucket = get_data_bucket()
-    workpace_bucket = get_bucket(file_url)
+    data_bucket = get_data_bucket(client=client)
+    workpace_bucket = get_bucket(file_url, client=client)
     source_blob = workpace_bucket.blob(file_url_parsed.path.lstrip('/'))
+    new_url = f'gs://{data_bucket.name}/{file_id}'
+    if workpace_bucket.name == data_bucket.name and source_blob.name == file_id:
+        # The file is already on the data bucket
+        logger.info('File %s is already on the data bucket', new_url)
+        return new_url, False
+    created = not data_bucket.blob(file_id).exists(client=client)
     new_blob = workpace_bucket.copy_blob(source_blob, data_bucket, file_id)
-    return f'gs://{data_bucket.name}/{new_blob.name}'
+    return f'gs://{data_bucket.name}/{new_blob.name}', created
 
 
 def merge(ancestor, theirs, mine):
-    mine = copy.deepcopy(mine)
+    # A shallow copy is enough: only top-level keys are assigned or deleted
+    # below, nested values are never modified. Note that the returned
+    # dictionary may share nested values with the arguments
+    mine = dict(mine)
     # Aliases for shorter code:
     #
     # a - ... - b      [i.e. global workspace]
@@ -625,148 +1148,196 @@ def merge(ancestor, theirs, mine):
     #
     a, b, c = ancestor, theirs, mine
 
-    keys = set(a) | set(b) | set(c)
-    for k in keys:
-        if k in a:
-            # First global case: the key existed before.
-            # Changes are either modification or deletions. However, when the
-            # new value equals the ancestor, it means no modification
-            # This means that if they key is not found in b or c, it was a deletion.
-            if k in b and k in c:
-                # Modifications on both branches
-                if b[k] == c[k]:
-                    # No conflict, same modification or no modification at all
-                    pass
-                elif a[k] == b[k] and b[k] != c[k]:
-                    # No change on b, modification on c. Accept c
-                    pass
-                elif a[k] == c[k] and b[k] != c[k]:
-                    # No change on c, modification on b. Accept b
-                    c[k] = b[k]
-                else:  # implied: a[k] != b[k] and a[k] != c[k] and b[k] != c[k]
-                    # Conflict, both modified the same with different values
-                    raise Conflict
-
-            elif k in b:  # implied: k not in c
-                # Possible modification in b and certainly deletion on c
-                if b[k] != a[k]:
-                    # There was a change on b, but c deleted it. Conflict
-                    raise Conflict
-                else:
-                    # There was no change on b, but c deleted it. Accept c
-                    pass
-
-            elif k in c:  # implied: k not in b
-                # Possible modification on c and certainly deletion on b
-                if c[k] != a[k]:
-                    # There was a change on c, but b deleted it. Conflict
-                    raise Conflict
-                else:
-                    # There was no change on c, but c deleted it. Accept b
-                    del c[k]
-
-        else:
-            # Second global case: the key did not exist before.
-            # Changes are additions
-            # This means that if the key is not found in b or c, it is
-            # because these branches did not do anything on this key
-            if k in b and k in c:
-                # Modification in both branches
-                if b[k] == c[k]:
-                    # No conflict, same modification
-                    pass
-                else:  # implied: b[k] != c[k]
-                    # Conflict, both modified the same with different values
-                    raise Conflict
-
-            elif k in b:  # implied: k not in c
-                # Modification on b but c did not do anything
-                # Accept whatever change b brings
-                c[k] = b[k]
-
-            elif k in c:  # implied: k not in b
-                # Modification on c but b did not do anything
-                # Accept whatever change c brings
-                pass
+    # Partition the keys according to the branches where they are present,
+    # so that each partition is handled without further membership tests
+    ak, bk, ck = set(a), set(b), set(c)
+
+    # First global case: the key existed before.
+    # Changes are either modification or deletions. However, when the
+    # new value equals the ancestor, it means no modification
+    # This means that if they key is not found in b or c, it was a deletion.
+    for k in ak & bk & ck:
+        # Modifications on both branches
+        if b[k] == c[k]:
+            # No conflict, same modification or no modification at all
+            pass
+        elif a[k] == b[k]:  # implied: b[k] != c[k]
+            # No change on b, modification on c. Accept c
+            pass
+        elif a[k] == c[k]:  # implied: b[k] != c[k]
+            # No change on c, modification on b. Accept b
+            c[k] = b[k]
+        else:  # implied: a[k] != b[k] and a[k] != c[k] and b[k] != c[k]
+            # Conflict, both modified the same with different values
+            raise Conflict
+
+    for k in (ak & bk) - ck:
+        # Possible modification in b and certainly deletion on c
+        if b[k] != a[k]:
+            # There was a change on b, but c deleted it. Conflict
+            raise Conflict
+        # Otherwise, there was no change on b, but c deleted it. Accept c
+
+    for k in (ak & ck) - bk:
+        # Possible modification on c and certainly deletion on b
+        if c[k] != a[k]:
+            # There was a change on c, but b deleted it. Conflict
+            raise Conflict
+        # Otherwise, there was no change on c, but b deleted it. Accept b
+        del c[k]
+
+    # Second global case: the key did not exist before.
+    # Changes are additions
+    # This means that if the key is not found in b or c, it is
+    # because these branches did not do anything on this key
+    for k in (bk & ck) - ak:
+        # Modification in both branches
+        if b[k] != c[k]:
+            # Conflict, both modified the same with different values
+            raise Conflict
+        # Otherwise, no conflict, same modification
+
+    for k in bk - ak - ck:
+        # Modification on b but c did not do anything
+        # Accept whatever change b brings
+        c[k] = b[k]
+
+    # Keys only in c are modifications on c where b did not do anything:
+    # they are accepted as they are.
+    # Keys only in a were deleted on both branches: nothing to do.
 
     return mine
 
 
-def _update_global_views():
-    # TODO: protect with a database lock
-    _update_global_table_views(f'global_views_{QueryDialect.POSTGRESQL.value}')
-    _update_global_json_views(f'global_views_{QueryDialect.POSTGRESQL_JSON.value}')
+@celery.task(bind=True, acks_late=True, autoretry_for=(SQLAlchemyError, OperationalError),
+             retry_backoff=True, retry_jitter=True, max_retries=5)
+def update_global_views(self, family_names=None):
+    """ Recreate the global views used by the public queries
 
+    This task is sent after each successful workspace commit. Queries on the
+    global views see the previous views until this task finishes. Database
+    errors are retried with an exponential backoff.
 
-def _update_global_table_views(schema_name):
-    logger.info('Updating global table views')
+    Parameters
+    ----------
+    family_names: list, optional
+        Names of the families that changed. Only the tables of these families
+        (and of the families that have no table yet) are recreated on the
+        table views. When not set, all the views are recreated.
 
-    # Create postgres schema
-    db.session.execute(DropSchemaIfExists(schema_name, cascade=True))
-    db.session.execute(CreateSchema(schema_name))
+    """
+    logger.info('Updating global views...')
+
+    if self.request.retries:
+        # A previous attempt failed and may have left the views in an
+        # unknown state: recreate all of them
+        family_names = None
+
+    try:
+        # Serialize the updates with a transaction-level advisory lock, so
+        # that two updates do not rebuild the same schemas at the same time
+        db.session.execute(select([func.pg_advisory_xact_lock(_GLOBAL_VIEWS_LOCK_ID)]))
+        _update_global_views(family_names)
+        db.session.commit()
+    except:
+        # Release the lock and leave the session usable for the retry
+        db.session.rollback()
+        raise
+
+
+@celery.task()
+def rebuild_global_views(task_id):
+    """ Recreate all the global views after a failed update
+
+    This task is the error callback of :py:func:`update_global_views` when
+    it only updates some families: once that update has failed, the tables
+    of these families are outdated.
+
+    Parameters
+    ----------
+    task_id: str
+        Identifier of the update task that failed.
+
+    """
+    logger.error('Update of the global views failed on task %s, recreating all views', task_id)
+    update_global_views.delay()
+
+
+def _update_global_views(family_names=None):
+    table_schema_name = f'global_views_{QueryDialect.POSTGRESQL.value}'
+    json_schema_name = f'global_views_{QueryDialect.POSTGRESQL_JSON.value}'
+
+    # Get all the known family names
+    all_family_names = _family_names(Family.query.filter(Family.fk_workspace_id.is_(None)).distinct())
+
+    if family_names is not None:
+        # Families without a table (new families without any metadata, or
+        # tables lost by a previous update) are always recreated
+        family_names = set(family_names) | (set(all_family_names) - _schema_table_names(table_schema_name))
+        if not family_names and _schema_table_names(json_schema_name):
+            logger.info('No family changed, the global views are up to date')
+            return
+
+    _update_global_table_views(table_schema_name, all_family_names, family_names)
+    _update_global_json_views(json_schema_name, all_family_names)
+
+
+def _schema_table_names(schema_name):
+    """Get the names of the tables of a schema, empty if it does not exist"""
+    rows = db.session.execute(
+        'SELECT c.relname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace '
+        "WHERE n.nspname = :name AND c.relkind = 'r'",
+        {'name': schema_name}
+    )
+    return {name for name, in rows}
+
+
+def _update_global_table_views(schema_name, all_family_names, family_names=None):
+    logger.info('Updating global table views')
 
-    # Get all the known families
-    families = Family.query.filter(Family.fk_workspace_id.is_(None)).distinct(Family.name)
     # This is the metadata entries related to the latest global families
     global_metadata = Metadata.get_latest_global()
 
-    # For each family, create a view/table
-    for family in families:
-        tmp = global_metadata.filter(Family.name == family.name).subquery()
-        keys_query = db.session.query(func.jsonb_object_keys(tmp.c.json)).distinct()
-        keys = set(res[0] for res in keys_query.all()) - {'id'}
-        logger.info('Keys for family %s are %s', family.name, keys)
-
-        # 2.1 Determine the type of all columns
-        # TODO consider this, for the moment, everything is a string
-        types_schema = {}
-        if family.name == 'base':  # TODO refactor base schema to an external variable
-            types_schema['size'] = types.BigInteger
-            types_schema['date'] = types.DateTime(timezone=True)
-
-        # 2.2 Create table
-        columns = [Metadata.json['id'].astext.cast(UUID).label('id')]
-        for k in keys:
-            col_k = Metadata.json[k].astext  # TODO: do we need to protect the key names from injection?
-            if k in types_schema:
-                col_k = col_k.cast(types_schema[k])
-            columns.append(col_k.label(k))
-
-        create_table_query = (
-            global_metadata.filter(Family.name == family.name,
-                                   Metadata.json['state'].astext != 'DELETED' if family.name == 'base' else True)
-            .with_entities(*columns)
-            .subquery()
-        )
-        family_table_name = f'{schema_name}.{family.name}'
-        create_table_statement = CreateTableAs(family_table_name, create_table_query)
-        db.session.execute(create_table_statement)
+    schema_exists = db.session.execute(
+        'SELECT 1 FROM pg_namespace WHERE nspname = :name', {'name': schema_name}
+    ).scalar()
+    if family_names is None or not schema_exists:
+        # Create postgres schema with all families
+        family_names = all_family_names
+        statements = [DropSchemaIfExists(schema_name, cascade=True), CreateSchema(schema_name)]
+    else:
+        # Only replace the tables of the families that changed, the tables
+        # of the other families are still up to date
+        family_names = [name for name in all_family_names if name in set(family_names)]
+        global_metadata = global_metadata.filter(Family.name.in_(family_names))
+        statements = [DropTableIfExists(f'{schema_name}.{name}') for name in family_names]
 
-        # TODO: create an index on the id column
+    # For each family, create a view/table
+    statements.extend(_family_tables_statements(global_metadata, family_names, schema_name))
 
     # Set permissions on readonly user to the schema contents
-    db.session.execute(GrantUsageOnSchema(schema_name, 'db_ro_user'))
+    statements.append(GrantUsageOnSchema(schema_name, 'db_ro_user'))
 
+    # Send all the statements in a single round-trip
+    _execute_all(statements)
 
-def _update_global_json_views(schema_name):
+
+def _update_global_json_views(schema_name, family_names):
     logger.info('Updating global json views')
 
     # Create postgres schema
     db.session.execute(DropSchemaIfExists(schema_name, cascade=True))
     db.session.execute(CreateSchema(schema_name))
 
-    # Get all the known families
-    families = Family.query.filter(Family.fk_workspace_id.is_(None)).distinct(Family.name)
     # This is the metadata entries related to the latest global families
     global_metadata = Metadata.get_latest_global()
     # Extract metadata per family
-    master_query = _make_json_view_query(global_metadata, families)
+    master_query = _make_json_view_query(global_metadata, family_names)
 
     family_table_name = f'{schema_name}.metadata'
     create_table_statement = CreateTableAs(family_table_name, master_query)
     db.session.execute(create_table_statement)
-
-    # TODO: create an index on the id column
+    _index_and_analyze(family_table_name)
 
     # Set permissions on readonly user to the schema contents
     db.session.execute(GrantUsageOnSchema(schema_name, 'db_ro_user'))
@@ -4,10 +4,11 @@ from requests import codes
 from connexion import request
 from kombu.exceptions import OperationalError
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
 from quetzal.app import db
 from quetzal.app.api.data.tasks import (
-    init_workspace, init_data_bucket,
+    init_workspace_and_bucket,
     wait_for_workspace, commit_workspace, delete_workspace, scan_workspace
 )
 from quetzal.app.api.exceptions import APIException, InvalidTransitionException
@@ -45,7 +46,9 @@ def fetch(*, user):
 
     # Filtering
     query_args = request.args
-    query_set = Workspace.query
+    # The owner is needed for each workspace in the response, load it in
+    # the same query
+    query_set = Workspace.query.options(joinedload(Workspace.owner))
 
     if 'name' in query_args:
         name = query_args['name']
@@ -65,7 +68,11 @@ def fetch(*, user):
     # TODO: consider permissions here and how it plays with owner in query_args
     query_set = query_set.order_by(Workspace.id.desc())
 
-    pager = paginate(query_set, serializer=Workspace.to_dict)
+    pager = paginate(query_set)
+    # The families of all the workspaces in the page are loaded with a
+    # single query, before serializing the page
+    families = _families_by_workspace(pager.items)
+    pager.serializer = lambda w: w.to_dict(families=families.get(w.id, []))
     return pager.response_object(), codes.ok
 
 
@@ -116,18 +123,20 @@ def create(*, body, user, token_info=None):
     families = body['families']
     if 'base' not in families:
         families['base'] = None
-    for name, version in families.items():
+    for name in families:
         if name in FAMILY_NAME_BLACKLIST:
             raise APIException(status=codes.bad_request,
                                title='Invalid family name',
                                detail=f'Family name "{name}" is not permitted')
-        family = Family(name=name,
-                        version=version,
-                        description='No description provided',
-                        fk_workspace_id=workspace.id)
-        logger.info('Adding family %s version %s to workspace %s',
-                    family, family.version, family.fk_workspace_id)
-        db.session.add(family)
+    # Insert all families at once, there is no need for Family objects here
+    logger.info('Adding families %s to workspace %s', families, workspace.id)
+    db.session.bulk_insert_mappings(Family, [
+        dict(name=name,
+             version=version,
+             description='No description provided',
+             fk_workspace_id=workspace.id)
+        for name, version in families.items()
+    ])
 
     # Schedule the initialization tasks.
     # Note that there is an egg and chicken problem here: we need to initialize
@@ -140,10 +149,8 @@ def create(*, body, user, token_info=None):
         chain = (
             # Wait for the workspace to be added to the database
             wait_for_workspace.si(workspace.id) |
-            # Initialize its families
-            init_workspace.si(workspace.id) |
-            # Initialize its resources
-            init_data_bucket.si(workspace.id)
+            # Initialize its families and resources in a single transaction
+            init_workspace_and_bucket.si(workspace.id)
         )
         background_task = chain.apply_async(countdown=1)
         # Log the celery chain in order
@@ -332,3 +339,28 @@ def scan(*, wid):
     log_task(background_task)
 
     return workspace.to_dict(), codes.accepted
+
+
+def _families_by_workspace(workspaces):
+    """Get the families of several workspaces with a single query
+
+    Returns
+    -------
+    dict
+        The name and version of the families of each workspace, indexed by
+        workspace id
+    """
+    families = {}
+    ids = [w.id for w in workspaces]
+    if ids:
+        # Only the columns used by Workspace.to_dict are needed: the rows have
+        # the same name and version attributes as the families, without the
+        # cost of creating and tracking a model instance for each one
+        query = (
+            Family.query
+            .filter(Family.fk_workspace_id.in_(ids))
+            .with_entities(Family.fk_workspace_id, Family.name, Family.version)
+        )
+        for family in query:
+            families.setdefault(family.fk_workspace_id, []).append(family)
+    return families
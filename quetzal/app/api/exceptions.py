@@ -40,3 +40,14 @@ class Conflict(QuetzalException):
 
 class EmptyCommit(QuetzalException):
     pass
+
+
+class CommitFilesException(WorkerException):
+    """Represents a failure while copying the files of a commit
+
+    The urls of the files that were copied before the failure are kept in
+    the `urls` attribute, so that they can be deleted.
+    """
+    def __init__(self, message, urls):
+        super().__init__(message)
+        self.urls = urls
@@ -3,9 +3,10 @@ Background tasks
 """
 
 import base64
-import binascii
+import json
 import logging
 import pathlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from .helpers.google_api import get_bucket
 from .helpers.files import get_readable_info
@@ -13,6 +14,12 @@ from .helpers.files import get_readable_info
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of log files uploaded concurrently
+_BACKUP_MAX_WORKERS = 16
+
+# Name of the file, in the log directory, with the md5 of the backed up logs
+_BACKUP_CACHE_FILENAME = '.backup_cache.json'
+
 
 def hello():
     try:
@@ -37,37 +44,106 @@ def backup_logs(app):
         bucket = get_bucket(log_bucket_name)
         errors = []
 
-        for log_file in log_dir.glob('*.log'):
-            try:
-                with open(log_dir / log_file, 'rb') as f:
-                    md5, size = get_readable_info(f)
-                    blob = bucket.get_blob('logs/' + log_file.name)
-                    copy = None
-
-                    if blob is not None:
-                        if md5 == binascii.hexlify(base64.b64decode(blob.md5_hash)).decode('utf-8') and size == blob.size:
-                            logger.info('Ignoring %s (already uploaded)', log_dir / log_file)
-                            continue
-                        # If blob exists, we need to rewrite it, but we cannot do this so
-                        # let's move it and upload it
-                        copy = bucket.blob(blob.name + '.bak')
-                        logger.info('Moving %s -> %s', blob.name, copy.name)
-                        copy.rewrite(blob)
-                        blob.delete()
-
-                    elif blob is None:
-                        # Blob does not exist, create it
-                        blob = bucket.blob('logs/' + log_file.name)
-
-                    logger.info('Uploading %s -> %s',
-                                log_file,
-                                log_bucket_name + '/' + blob.name)
-                    blob.upload_from_file(f, rewind=True)
-                    if copy:
-                        copy.delete()
-
-            except Exception as ex:
-                errors.append(ex)
+        # Each log backup is dominated by the latency of the storage API calls,
+        # so they are done concurrently
+        cache = _load_backup_cache(log_dir)
+        new_cache = {}
+        # Retrieve the information of all the backed up logs at once instead
+        # of one request per log file
+        remote_blobs = {
+            blob.name: blob
+            for blob in bucket.list_blobs(prefix='logs/',
+                                          fields='items(name,size,md5Hash),nextPageToken')
+        }
+        with ThreadPoolExecutor(max_workers=_BACKUP_MAX_WORKERS) as executor:
+            futures = [executor.submit(_backup_log, log_file, bucket,
+                                       remote_blobs.get('logs/' + log_file.name),
+                                       cache.get(log_file.name))
+                       for log_file in log_dir.glob('*.log')]
+            for future in as_completed(futures):
+                ex = future.exception()
+                if ex is not None:
+                    errors.append(ex)
+                elif future.result() is not None:
+                    name, entry = future.result()
+                    new_cache[name] = entry
+        _save_backup_cache(log_dir, new_cache)
 
         if errors:
             logger.error('Failed to backup %d log files: %s', len(errors), errors)
+
+
+def _backup_log(log_file, bucket, blob, cache_entry):
+    # Keep the file information before anything is read or uploaded: if the
+    # file is modified in the meantime, it will not match on the next backup
+    stat = log_file.stat()
+    copy = None
+
+    if blob is not None:
+        # Files of a different size cannot be identical: the md5 is only
+        # needed when the sizes match, and only calculated when the file
+        # changed since the last backup.
+        # The md5 is compared in base64, which is how the blob has it
+        if blob.size == stat.st_size:
+            if _cache_entry_matches(cache_entry, stat):
+                md5_hash = cache_entry['md5_hash']
+            else:
+                with open(log_file, 'rb') as f:
+                    md5, _ = get_readable_info(f)
+                md5_hash = base64.b64encode(bytes.fromhex(md5)).decode('ascii')
+            if md5_hash == blob.md5_hash:
+                logger.info('Ignoring %s (already uploaded)', log_file)
+                return log_file.name, _cache_entry(stat, md5_hash)
+
+        # If blob exists, we need to rewrite it, but we cannot do this so
+        # let's move it and upload it
+        copy = bucket.blob(blob.name + '.bak')
+        logger.info('Moving %s -> %s', blob.name, copy.name)
+        copy.rewrite(blob)
+        blob.delete()
+
+    else:
+        # Blob does not exist, create it
+        blob = bucket.blob('logs/' + log_file.name)
+
+    logger.info('Uploading %s -> %s',
+                log_file,
+                bucket.name + '/' + blob.name)
+    blob.upload_from_filename(str(log_file))
+    if copy:
+        copy.delete()
+
+    # The uploaded blob only corresponds to the file information obtained
+    # above when the file was not appended in the meantime
+    if blob.size != stat.st_size or blob.md5_hash is None:
+        return None
+    return log_file.name, _cache_entry(stat, blob.md5_hash)
+
+
+def _cache_entry(stat, md5_hash):
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'md5_hash': md5_hash}
+
+
+def _cache_entry_matches(entry, stat):
+    return (entry is not None and
+            'md5_hash' in entry and
+            entry.get('size') == stat.st_size and
+            entry.get('mtime_ns') == stat.st_mtime_ns)
+
+
+def _load_backup_cache(log_dir):
+    # The cache saves the md5 of the files that were already backed up, so
+    # that unchanged log files are not read again
+    try:
+        with open(log_dir / _BACKUP_CACHE_FILENAME, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_backup_cache(log_dir, cache):
+    try:
+        with open(log_dir / _BACKUP_CACHE_FILENAME, 'w') as f:
+            json.dump(cache, f)
+    except OSError as ex:
+        logger.warning('Could not save log backup cache: %s', ex)
@@ -1,5 +1,8 @@
+import functools
 import pathlib
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 from flask.cli import AppGroup
@@ -9,24 +12,6 @@ from quetzal.app import __version__
 
 deploy_cli = AppGroup('deploy', help='Deployment operations.')
 
-# Regex on semver taken from
-# https://github.com/semver/semver/issues/232#issuecomment-430840155
-semver_re = re.compile(
-    r'^'
-    r'(?P<Major>0|[1-9]\d*)\.'
-    r'(?P<Minor>0|[1-9]\d*)\.'
-    r'(?P<Patch>0|[1-9]\d*)'
-    r'(?P<PreReleaseTagWithSeparator>'
-      r'-(?P<PreReleaseTag>'
-        r'(?:0|[1-9]\d*|\d*[A-Z-a-z-][\dA-Za-z-]*)(?:\.(?:0|[1-9]\d*|\d*[A-Za-z-][\dA-Za-z-]*))*'
-      r')'
-    r')?'
-    r'(?P<BuildMetadataTagWithSeparator>'
-      r'\+(?P<BuildMetadataTag>[\dA-Za-z-]+(\.[\dA-Za-z-]*)*)'
-    r')?'
-    r'$'
-)
-
 
 @deploy_cli.command('create-images')
 @click.option('--registry',
@@ -64,7 +49,7 @@ def create_docker_images(ctx, registry, images):
 
     # Determine version tag
     app_version = __version__
-    semver_match = semver_re.match(app_version)
+    semver_match = _semver_re().match(app_version)
     if semver_match:
         # take semver without the build tag
         version = '{major}.{minor}.{patch}{prerelease}'.format(
@@ -82,10 +67,20 @@ def create_docker_images(ctx, registry, images):
     else:
         raise click.ClickException('Version string does not conform to semver')
 
-    # Build and push each image
+    # Build each image. Builds are kept sequential since they share the
+    # docker build cache
+    built_tags = []
     for i in images:
-        _build_image(client, tag=f'quetzal/{i}:{version}',
-                     registry=registry, **images_kwargs[i])
+        tag = f'quetzal/{i}:{version}'
+        _build_image(client, tag=tag, registry=registry, **images_kwargs[i])
+        built_tags.append(tag)
+
+    # Push all images concurrently, since pushing is mostly waiting for the
+    # registry
+    if registry:
+        echo_lock = threading.Lock()
+        with ThreadPoolExecutor(max_workers=len(built_tags)) as executor:
+            list(executor.map(lambda t: _push_image(client, t, registry, echo_lock), built_tags))
 
 
 def _build_image(client, **kwargs):
@@ -97,12 +92,40 @@ def _build_image(client, **kwargs):
         if 'stream' in line and line['stream'].strip():
             click.echo(line['stream'].strip())
     if registry:
-        click.secho(f'Uploading {registry}/{tag}...', fg='blue')
-        full_tag = f'{registry}/{tag}'
-        image.tag(full_tag)
-        for line in client.images.push(full_tag, stream=True, decode=True):
-            if 'error' in line:
-                raise click.ClickException(line['error'].strip())
-            if 'stream' in line and line['stream'].strip():
-                click.echo(line['stream'].strip())
+        image.tag(f'{registry}/{tag}')
     return image
+
+
+def _push_image(client, tag, registry, echo_lock):
+    full_tag = f'{registry}/{tag}'
+    with echo_lock:
+        click.secho(f'Uploading {full_tag}...', fg='blue')
+    for line in client.images.push(full_tag, stream=True, decode=True):
+        if 'error' in line:
+            raise click.ClickException(line['error'].strip())
+        if 'stream' in line and line['stream'].strip():
+            # Prefix each line with its image since pushes are interleaved
+            with echo_lock:
+                click.echo(f'[{tag}] {line["stream"].strip()}')
+
+
+@functools.lru_cache(maxsize=1)
+def _semver_re():
+    # Regex on semver taken from
+    # https://github.com/semver/semver/issues/232#issuecomment-430840155
+    # It is compiled on the first use rather than on every import of the CLI
+    return re.compile(
+        r'^'
+        r'(?P<Major>0|[1-9]\d*)\.'
+        r'(?P<Minor>0|[1-9]\d*)\.'
+        r'(?P<Patch>0|[1-9]\d*)'
+        r'(?P<PreReleaseTagWithSeparator>'
+          r'-(?P<PreReleaseTag>'
+            r'(?:0|[1-9]\d*|\d*[A-Z-a-z-][\dA-Za-z-]*)(?:\.(?:0|[1-9]\d*|\d*[A-Za-z-][\dA-Za-z-]*))*'
+          r')'
+        r')?'
+        r'(?P<BuildMetadataTagWithSeparator>'
+          r'\+(?P<BuildMetadataTag>[\dA-Za-z-]+(\.[\dA-Za-z-]*)*)'
+        r')?'
+        r'$'
+    )
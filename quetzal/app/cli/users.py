@@ -1,6 +1,9 @@
+import itertools
+
 import click
 from flask.cli import AppGroup
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
 
 from quetzal.app import db
 from quetzal.app.models import ApiKey, User, Role
@@ -10,6 +13,9 @@ user_cli = AppGroup('user', help='User operations.')
 role_cli = AppGroup('role', help='Role operations.')
 keys_cli = AppGroup('keys', help='API keys operations.')
 
+# Number of entries retrieved and written at once by the list commands
+_LIST_BATCH_SIZE = 500
+
 
 @user_cli.command('create')
 @click.argument('username')
@@ -32,12 +38,17 @@ def user_create(username, email, password):
 @user_cli.command('list')
 def user_list():
     """List existing users"""
-    if User.query.count() == 0:
-        click.secho('No users exist')
-    else:
-        click.secho('Users:\nID\tUSERNAME\t\tE-MAIL\t\t\tROLES')
-        for user in User.query.all():
-            click.secho(f'{user.id}\t{user.username}\t\t{user.email}\t\t\t{",".join([r.name for r in user.roles])}')
+    # Load the roles of the users in one query per batch instead of one per user
+    users = (
+        User.query
+        .options(selectinload(User.roles))
+        .execution_options(stream_results=True)
+        .yield_per(_LIST_BATCH_SIZE)
+    )
+    _echo_listing('Users:\nID\tUSERNAME\t\tE-MAIL\t\t\tROLES',
+                  (f'{user.id}\t{user.username}\t\t{user.email}\t\t\t{",".join([r.name for r in user.roles])}'
+                   for user in users),
+                  'No users exist')
 
 
 @role_cli.command('create')
@@ -72,12 +83,10 @@ def role_delete(name):
 @role_cli.command('list')
 def role_list():
     """List existing roles"""
-    if Role.query.count() == 0:
-        click.secho('No roles exist')
-    else:
-        click.secho('Roles:\nID\tNAME\tDESCRIPTION')
-        for role in Role.query.all():
-            click.secho(f'{role.id}\t{role.name}\t{role.description}')
+    roles = Role.query.execution_options(stream_results=True).yield_per(_LIST_BATCH_SIZE)
+    _echo_listing('Roles:\nID\tNAME\tDESCRIPTION',
+                  (f'{role.id}\t{role.name}\t{role.description}' for role in roles),
+                  'No roles exist')
 
 
 @role_cli.command('add')
@@ -89,8 +98,10 @@ def role_add_user(username, rolename):
     if user is None:
         raise click.ClickException(f'User {username} does not exist')
 
+    # Retrieve all the requested roles in one query
+    roles = {role.name: role for role in Role.query.filter(Role.name.in_(rolename))}
     for rn in rolename:
-        role = Role.query.filter_by(name=rn).first()
+        role = roles.get(rn)
         if role is None:
             raise click.ClickException(f'Role {rn} does not exist')
 
@@ -149,13 +160,15 @@ def key_add(username, name):
 @keys_cli.command('list')
 def key_list():
     """List existing API keys"""
-
-    if ApiKey.query.count() == 0:
-        click.secho('No API key exist')
-    else:
-        click.secho('API keys:\nID\tNAME\tUSERNAME')
-        for key in ApiKey.query.all():
-            click.secho(f'{key.id}\t{key.name}\t{key.user.username}')
+    keys = (
+        ApiKey.query
+        .options(joinedload(ApiKey.user))
+        .execution_options(stream_results=True)
+        .yield_per(_LIST_BATCH_SIZE)
+    )
+    _echo_listing('API keys:\nID\tNAME\tUSERNAME',
+                  (f'{key.id}\t{key.name}\t{key.user.username}' for key in keys),
+                  'No API key exist')
 
 
 @keys_cli.command('revoke')
@@ -173,3 +186,21 @@ def key_revoke(username, name):
             click.echo(f'Removing key {name} for user {username}')
             db.session.delete(key)
     db.session.commit()
+
+
+def _echo_listing(header, lines, empty_message):
+    # Write the lines by batches: one write per batch instead of one per line,
+    # without keeping all the lines in memory
+    lines = iter(lines)
+    empty = True
+    while True:
+        batch = list(itertools.islice(lines, _LIST_BATCH_SIZE))
+        if not batch:
+            break
+        if empty:
+            batch.insert(0, header)
+            empty = False
+        click.secho('\n'.join(batch))
+
+    if empty:
+        click.secho(empty_message)
@@ -1,5 +1,5 @@
-import inspect
 import secrets
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import click
 from flask import current_app
@@ -11,6 +11,9 @@ from quetzal.app.api.data.tasks import delete_workspace
 
 utils_cli = AppGroup('utils', help='Miscelaneous operations.')
 
+# Maximum number of workspaces deleted concurrently by nuke
+_NUKE_MAX_WORKERS = 8
+
 
 @utils_cli.command('generate-secret-key')
 @click.argument('num_bytes', metavar='SIZE', type=click.INT, default=16)
@@ -28,6 +31,7 @@ def generate_secret_key(num_bytes, show=True):
 def nuke(keep_users):
     """Erase the database. Use with care."""
     width, _ = click.get_terminal_size()
+    banner = '*' * width
     env = current_app.env
     if env == 'production':
         bad = 'A REALLY BAD IDEA'
@@ -35,38 +39,39 @@ def nuke(keep_users):
         bad = 'probably ok'
     else:
         bad = 'maybe a bad idea'
-    click.secho('*'*width, fg='yellow')
+    click.secho(banner, fg='yellow')
     click.secho('This command will *DELETE* the database, losing *ALL* '
                 'metadata, workspaces, users, roles.\n'
                 'Please confirm THREE '
                 'times by answering the following questions.', fg='yellow')
-    click.secho('*'*width, fg='yellow')
+    click.secho(banner, fg='yellow')
     click.confirm('Are you sure?', abort=True, default=False)
 
-    click.secho('*' * width, fg='red')
+    click.secho(banner, fg='red')
     click.secho('This is your second warning.\n'
                 'All files in the bucket storage will be lost as well. '
                 'If you are not sure, abort now.',
                 fg='red')
-    click.secho('*' * width, fg='red')
+    click.secho(banner, fg='red')
     click.confirm('Do you really want to erase all?', abort=True, default=False)
 
-    click.secho('*' * width, bg='red', fg='white', blink=True)
+    click.secho(banner, bg='red', fg='white', blink=True)
     click.secho(f'This is your last chance. EVERYTHING will be lost.\n'
                 f'The only reason you should be doing this is because you '
                 f'are resetting a development server.\n'
                 f'Your current FLASK_ENV is "{env}" so continuing is {bad}.\n'
                 f'This is the final confirmation...',
                 bg='red', fg='white', blink=True)
-    click.secho('*' * width, bg='red', fg='white', blink=True)
+    click.secho(banner, bg='red', fg='white', blink=True)
     abort = click.confirm('Do you want to abort?', abort=False, default=True)
     if abort:
         raise click.Abort()
 
     blacklist = []
     if keep_users:
-        blacklist.append(quetzal.app.models.User)
-        blacklist.append(quetzal.app.models.Role)
+        blacklist.append(quetzal.app.models.User.__table__)
+        blacklist.append(quetzal.app.models.Role.__table__)
+        blacklist.append(quetzal.app.models.roles_users_table)
 
     # Delete all files in all workspaces
     workspaces_with_data = db.session.query(quetzal.app.models.Workspace).filter(
@@ -74,30 +79,44 @@ def nuke(keep_users):
         quetzal.app.models.Workspace.data_url.isnot(None),
     )
     click.echo(f'Erasing {workspaces_with_data.count()} workspaces...')
-    for workspace_id in [w.id for w in workspaces_with_data]:
-        # For some weird reason, in this loop I need to use directly the
-        # workspace.id instead of the instance or I get a
-        # sqlalchemy.orm.exc.DetachedInstanceError
-        try:
+    # Delete the workspaces concurrently, since each deletion is mostly
+    # waiting for the storage backend. The deletion tasks are executed here
+    # rather than on the workers because the database entries are erased
+    # right after
+    app = current_app._get_current_object()
+
+    def _delete_workspace_in_context(workspace_id):
+        # The application context is thread-local: each thread needs its own
+        with app.app_context():
             delete_workspace(workspace_id, force=True)
-        except Exception as ex:
-            click.secho(f'Could not delete workspace {workspace_id}: '
-                        f'{type(ex).__name__}: {ex}')
-            continue
 
-    classes = inspect.getmembers(quetzal.app.models, inspect.isclass)
+    with ThreadPoolExecutor(max_workers=_NUKE_MAX_WORKERS) as executor:
+        futures = {
+            executor.submit(_delete_workspace_in_context, workspace_id): workspace_id
+            for workspace_id in [w.id for w in workspaces_with_data]
+        }
+        for future in as_completed(futures):
+            ex = future.exception()
+            if ex is not None:
+                click.secho(f'Could not delete workspace {futures[future]}: '
+                            f'{type(ex).__name__}: {ex}')
 
-    with db.session.no_autoflush:
-        # Disabling autoflush because intermediate deletes would violate some
-        # not null constraints.
-        for name, cls in classes:
-            if issubclass(cls, db.Model) and cls not in blacklist:
-                instances = db.session.query(cls)
-                click.echo(f'Erasing all {instances.count()} '
-                           f'entries of {cls.__name__}...')
-                for i in instances.all():
-                    db.session.delete(i)
+    # Workspaces and metadata reference each other: remove the reference of
+    # the workspaces so that each table can be deleted entirely afterwards
+    db.session.query(quetzal.app.models.Workspace).update(
+        {quetzal.app.models.Workspace.fk_last_metadata_id: None},
+        synchronize_session=False,
+    )
+
+    # Delete all the entries of each table in a single statement, following
+    # the reverse order of their dependencies so that no foreign key
+    # constraint is violated
+    for table in reversed(db.metadata.sorted_tables):
+        if table in blacklist:
+            continue
+        result = db.session.execute(table.delete())
+        click.echo(f'Erased all {result.rowcount} entries of {table.name}.')
 
-        db.session.commit()
+    db.session.commit()
 
     click.secho('Database entries removed.', color='blue')
@@ -2,6 +2,10 @@ import hashlib
 import os
 
 
+# Size of the chunks read when hashing a file
+_CHUNK_SIZE = 1024 * 1024
+
+
 def split_check_path(filepath):
     filepath = os.path.normpath('/' + filepath).lstrip('/')  # Protect against traversal
     return os.path.split(filepath)
@@ -20,7 +24,7 @@ def get_readable_info(file_obj):
     Parameters
     ----------
     file_obj: file-like
-        File object. It needs the `read` and `tell` methods.
+        File object. It needs the `read`, `seek` and `tell` methods.
 
     Returns
     -------
@@ -28,14 +32,25 @@ def get_readable_info(file_obj):
         MD5 sum and size of the file object contents
 
     """
-    size = 0
     position = file_obj.tell()
-    hashobj = hashlib.new('md5')
-    while True:
-        chunk = file_obj.read(4096)
-        size += len(chunk)
-        if not chunk:
-            break
-        hashobj.update(chunk)
+    md5 = None
+    if position == 0 and hasattr(hashlib, 'file_digest'):
+        # Python >= 3.11 reads and hashes the file without a Python loop
+        try:
+            md5 = hashlib.file_digest(file_obj, 'md5').hexdigest()
+        except (AttributeError, ValueError):
+            # Not a readable binary file object, use the loop below
+            file_obj.seek(position)
+
+    if md5 is None:
+        hashobj = hashlib.new('md5')
+        for chunk in iter(lambda: file_obj.read(_CHUNK_SIZE), b''):
+            hashobj.update(chunk)
+        md5 = hashobj.hexdigest()
+
+    # The size does not need the contents: it is the distance between the
+    # original position and the end of the file
+    file_obj.seek(0, os.SEEK_END)
+    size = file_obj.tell() - position
     file_obj.seek(position)
-    return hashobj.hexdigest(), size
+    return md5, size
@@ -6,6 +6,10 @@ from requests import codes
 
 from quetzal.app.api.exceptions import APIException, ObjectNotFoundException
 
+# Default page and page size, as declared in the openapi specification
+DEFAULT_PAGE = 1
+DEFAULT_PER_PAGE = 100
+
 
 class CustomPagination(Pagination):
     """A specialization of flask_sqlalchemy pagination object
@@ -21,15 +25,36 @@ class CustomPagination(Pagination):
     """
     def __init__(self, *args, **kwargs):
         self.serializer = kwargs.pop('serializer') or (lambda x: x)
+        self.keyset_column = kwargs.pop('keyset_column', None)
+        self.next_keyset_value = kwargs.pop('next_keyset_value', None)
+        self._has_next = kwargs.pop('has_next', None)
         super().__init__(*args, **kwargs)
 
+    @property
+    def has_next(self):
+        """True if a next page exists."""
+        if self._has_next is not None:
+            return self._has_next
+        return super().has_next
+
     def response_object(self):
-        return {
-            'page': self.page,
-            'pages': self.pages,
-            'total': self.total,
-            'results': [self.serializer(i) for i in self.items],
-        }
+        if self.total is None:
+            # The total was not requested: there is no number of pages either
+            response = {
+                'page': self.page,
+                'has_next': self.has_next,
+                'results': [self.serializer(i) for i in self.items],
+            }
+        else:
+            response = {
+                'page': self.page,
+                'pages': self.pages,
+                'total': self.total,
+                'results': [self.serializer(i) for i in self.items],
+            }
+        if self.keyset_column is not None:
+            response['next_cursor'] = self.next_keyset_value
+        return response
 
     def prev(self, error_out=False):
         """Returns a :class:`Pagination` object for the previous page."""
@@ -43,10 +68,14 @@ class CustomPagination(Pagination):
         """Returns a :class:`Pagination` object for the next page."""
         assert self.query is not None, 'a query object is required ' \
                                        'for this method to work'
+        if self.keyset_column is not None:
+            return paginate(self.query, page=self.page + 1, per_page=self.per_page, error_out=error_out,
+                            keyset_column=self.keyset_column, keyset_value=self.next_keyset_value)
         return paginate(self.query, page=self.page + 1, per_page=self.per_page, error_out=error_out)
 
 
-def paginate(queriable, *, page=None, per_page=None, error_out=True, max_per_page=None, serializer=None):
+def paginate(queriable, *, page=None, per_page=None, error_out=True, max_per_page=None, serializer=None,
+             keyset_column=None, keyset_value=None, with_total=True):
     """Returns ``per_page`` items from page ``page``.
 
     This is a specialization of `flask_sqlalchemy.BaseQuery.paginate` with some
@@ -66,12 +95,27 @@ def paginate(queriable, *, page=None, per_page=None, error_out=True, max_per_pag
 
     * Uses keyword arguments to avoid incorrect arguments
 
+    * When ``keyset_column`` is set, a `flask_sqlalchemy.BaseQuery` is
+      paginated by keyset: the items are ordered by this column and only those
+      after ``keyset_value`` are retrieved. Unlike an offset, this does not
+      need to scan all the items of the previous pages. If ``keyset_value``
+      is ``None``, it is retrieved from the ``cursor`` request query. The
+      ``page`` is not used in this case. Without any keyset value, the items
+      are still ordered by this column but the page is retrieved by its
+      offset. When there is a next page, the key of the last item is
+      available as ``next_keyset_value`` in the pagination object and as
+      ``next_cursor`` in its response object.
+
+    * When ``with_total`` is ``False``, a `flask_sqlalchemy.BaseQuery` is not
+      counted. The total and number of pages are ``None`` and the response
+      object reports whether there is a next page with ``has_next`` instead.
+
     The original docstring is as follows:
 
     If ``page`` or ``per_page`` are ``None``, they will be retrieved from
     the request query. If ``max_per_page`` is specified, ``per_page`` will
     be limited to that value. If there is no request or they aren't in the
-    query, they default to 1 and 20 respectively.
+    query, they default to 1 and 100 respectively.
 
     When ``error_out`` is ``True`` (default), the following rules will
     cause a 404 response:
@@ -81,7 +125,7 @@ def paginate(queriable, *, page=None, per_page=None, error_out=True, max_per_pag
     * ``page`` or ``per_page`` are not ints.
 
     When ``error_out`` is ``False``, ``page`` and ``per_page`` default to
-    1 and 20 respectively.
+    1 and 100 respectively.
 
     Returns a :class:`CustomPagination` object.
     """
@@ -93,31 +137,40 @@ def paginate(queriable, *, page=None, per_page=None, error_out=True, max_per_pag
     if request:
         if page is None:
             try:
-                page = int(request.args.get('page', 1))
+                page = int(request.args.get('page', DEFAULT_PAGE))
             except (TypeError, ValueError):
                 if error_out:
                     raise APIException(status=codes.bad_request,
                                        title='Invalid paging parameters',
                                        detail='page parameter must be an integer')
 
-                page = 1
+                page = DEFAULT_PAGE
 
         if per_page is None:
             try:
-                per_page = int(request.args.get('per_page', 20))
+                per_page = int(request.args.get('per_page', DEFAULT_PER_PAGE))
             except (TypeError, ValueError):
                 if error_out:
                     raise APIException(status=codes.bad_request,
                                        title='Invalid paging parameters',
                                        detail='per_page parameter must be an integer')
 
-                per_page = 20
+                per_page = DEFAULT_PER_PAGE
+
+        if keyset_column is not None and keyset_value is None and 'cursor' in request.args:
+            try:
+                keyset_value = keyset_column.type.python_type(request.args['cursor'])
+            except (TypeError, ValueError):
+                if error_out:
+                    raise APIException(status=codes.bad_request,
+                                       title='Invalid paging parameters',
+                                       detail='cursor parameter is not valid')
     else:
         if page is None:
-            page = 1
+            page = DEFAULT_PAGE
 
         if per_page is None:
-            per_page = 20
+            per_page = DEFAULT_PER_PAGE
 
     if max_per_page is not None:
         per_page = min(per_page, max_per_page)
@@ -128,7 +181,7 @@ def paginate(queriable, *, page=None, per_page=None, error_out=True, max_per_pag
                                title='Invalid paging parameters',
                                detail='page parameter must be positive')
         else:
-            page = 1
+            page = DEFAULT_PAGE
 
     if per_page < 0:
         if error_out:
@@ -136,10 +189,27 @@ def paginate(queriable, *, page=None, per_page=None, error_out=True, max_per_pag
                                title='Invalid paging parameters',
                                detail='per_page parameter must be positive')
         else:
-            per_page = 20
+            per_page = DEFAULT_PER_PAGE
 
+    next_keyset_value = None
+    has_next = None
+    # Without a keyset value, the page is retrieved by its offset
+    by_keyset = keyset_column is not None and keyset_value is not None
     if isinstance(queriable, BaseQuery):
-        items = queriable.limit(per_page).offset((page - 1) * per_page).all()
+        if keyset_column is not None:
+            # The keyset order is also used for the offset pages, so that
+            # their next cursor is correct
+            queriable = queriable.order_by(None).order_by(keyset_column)
+        if by_keyset:
+            page_query = queriable.filter(keyset_column > keyset_value)
+        else:
+            page_query = queriable.offset((page - 1) * per_page)
+        # Fetch one additional item to know if there is a next page
+        rows = page_query.limit(per_page + 1).all()
+        has_next = len(rows) > per_page
+        items = rows[:per_page]
+        if keyset_column is not None and has_next:
+            next_keyset_value = getattr(items[-1], keyset_column.key)
     else:
         try:
             queriable.scroll((page - 1) * per_page, mode='absolute')
@@ -149,19 +219,29 @@ def paginate(queriable, *, page=None, per_page=None, error_out=True, max_per_pag
             # Set the items to empty, an error is handled later
             items = []
 
-    if not items and page != 1 and error_out:
+    # The page number is not used when paginating by keyset
+    first_page = not by_keyset and page == 1
+
+    if not items and not first_page and error_out:
         raise ObjectNotFoundException(status=codes.not_found,
                                       title='Not found',
                                       detail='Page request is out of range of results')
 
     # No need to count if we're on the first page and there are fewer
     # items than we expected.
-    if page == 1 and len(items) < per_page:
+    if isinstance(queriable, BaseQuery) and not with_total:
+        total = None
+    elif first_page and len(items) < per_page:
         total = len(items)
+    elif isinstance(queriable, BaseQuery) and not by_keyset and items and not has_next:
+        # No need to count either on the last page
+        total = (page - 1) * per_page + len(items)
     else:
         if isinstance(queriable, BaseQuery):
             total = queriable.order_by(None).count()
         else:
             total = queriable.rowcount
 
-    return CustomPagination(queriable, page, per_page, total, items, serializer=serializer)
+    return CustomPagination(queriable, page, per_page, total, items, serializer=serializer,
+                            keyset_column=keyset_column, next_keyset_value=next_keyset_value,
+                            has_next=has_next)
@@ -9,19 +9,52 @@ from sqlalchemy.sql.expression import ClauseElement
 # inspired from https://stackoverflow.com/a/30577608/227103
 class CreateTableAs(Executable, ClauseElement):
 
-    def __init__(self, name, query):
+    def __init__(self, name, query, temporary=False):
         self.name = name
         self.query = query
+        self.temporary = temporary
 
 
 @compiles(CreateTableAs, 'postgresql')
 def _create_table_as(element, compiler, **kwargs):
+    if element.temporary:
+        # Temporary tables are dropped at the end of the transaction
+        return 'CREATE TEMPORARY TABLE %s ON COMMIT DROP AS %s' % (
+            element.name,
+            compiler.process(element.query, **kwargs)
+        )
     return 'CREATE TABLE %s AS %s' % (
         element.name,
-        compiler.process(element.query)
+        compiler.process(element.query, **kwargs)
     )
 
 
+class CreateIndexOn(Executable, ClauseElement):
+
+    def __init__(self, table, column):
+        self.table = table
+        self.column = column
+
+
+@compiles(CreateIndexOn, 'postgresql')
+def _create_index_on(element, compiler, **kwargs):
+    return 'CREATE INDEX ON %s (%s)' % (
+        element.table,
+        element.column,
+    )
+
+
+class Analyze(Executable, ClauseElement):
+
+    def __init__(self, table):
+        self.table = table
+
+
+@compiles(Analyze, 'postgresql')
+def _analyze(element, compiler, **kwargs):
+    return 'ANALYZE %s' % element.table
+
+
 class DropSchemaIfExists(Executable, ClauseElement):
 
     def __init__(self, name, cascade=False):
@@ -39,6 +72,17 @@ def _drop_schema_if_exists(element, compiler, **kwargs):
     return text
 
 
+class DropTableIfExists(Executable, ClauseElement):
+
+    def __init__(self, name):
+        self.name = name
+
+
+@compiles(DropTableIfExists, 'postgresql')
+def _drop_table_if_exists(element, compiler, **kwargs):
+    return 'DROP TABLE IF EXISTS %s' % element.name
+
+
 class GrantUsageOnSchema(Executable, ClauseElement):
 
     def __init__(self, schema, user):
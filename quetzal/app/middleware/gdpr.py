@@ -1,70 +1,118 @@
-import base64
+import functools
 import logging
 
 
 logger = logging.getLogger(__name__)
 
+# Headers (in lowercase) whose values are never logged, and the name of the
+# same headers in the WSGI environment
+_REDACTED_HEADERS = frozenset({
+    'authorization', 'cookie', 'proxy-authorization', 'set-cookie', 'x-api-key',
+})
+_REDACTED_ENVIRON = frozenset('HTTP_' + h.upper().replace('-', '_') for h in _REDACTED_HEADERS)
+
+# Maximum size of the request data that is logged
+_MAX_DATA_LENGTH_BYTES = 4096
+
+
+def gdpr_logging_enabled():
+    """Determine if the GDPR request log would write anything"""
+    return logger.isEnabledFor(logging.DEBUG)
+
 
 def gdpr_log_request():
+    # Quit early if the logging level is not low enough, before any import.
+    # Note that isEnabledFor caches its result, unlike getEffectiveLevel
+    if not gdpr_logging_enabled():
+        return
+
     from flask import request
+    from sqlalchemy.exc import SQLAlchemyError
     from quetzal.app.models import ApiKey, User
 
-    # Quit early if the logging level is not low enough
-    if logger.getEffectiveLevel() > logging.DEBUG:
-        return
-
+    # The headers, environment and data are only captured, with their
+    # sensitive values redacted, when the log entry is actually formatted
     log_entry = {
-        'headers': {
-            key: value
-            for key, value in request.headers
-        },
-        'environment': {
-            key: repr(value)
-            for key, value in request.environ.items()
-        },
+        'headers': _LazyRepr(functools.partial(_redacted_headers, request.headers)),
+        'environment': _LazyRepr(functools.partial(_redacted_environ, request.environ)),
         'url': request.url,
         'full_path': request.full_path,
         'method': request.method,
-        'data': request.data,
+        'data': _LazyRepr(functools.partial(_request_data, request._get_current_object())),
         'user': None,
     }
     user = None
 
-    if 'Authorization' in request.headers:
+    # Werkzeug already parses basic authentication (and caches it on the
+    # request); only bearer tokens need to be extracted from the header
+    authorization = request.headers.get('Authorization', '')
+    if request.authorization is not None and request.authorization.type == 'basic':
+        # Log the username as sent: the authentication itself verifies it
+        log_entry['user'] = request.authorization.username
+    elif authorization[:7].lower() == 'bearer ':
         try:
-            auth_type, content = request.headers['Authorization'].split(None, 1)
-            if auth_type.lower() == 'basic':
-                username, _ = base64.b64decode(content).decode('latin1').split(':', 1)
-                user = User.query.filter_by(username=username).first()
-            elif auth_type.lower() == 'bearer':
-                user = User.check_token(content)
-
-            log_entry['headers']['Authorization'] = f'{auth_type} ...REDACTED...'
-
-        except:
+            user = User.check_token(authorization[7:].strip())
+        except SQLAlchemyError:
             logger.debug('Could not determine user', exc_info=True)
 
-    if 'HTTP_AUTHORIZATION' in request.environ:
-        try:
-            auth_type, _ = request.environ['HTTP_AUTHORIZATION'].split(None, 1)
-            log_entry['environment']['HTTP_AUTHORIZATION'] = f'{auth_type} ...REDACTED...'
-        except:
-            pass
-
-    if 'X-Api-Key' in request.headers:
-        key = request.headers['X-Api-Key']
-        log_entry['headers']['X-Api-Key'] = f'...REDACTED...'
+    key = request.headers.get('X-Api-Key')
+    if key:
         try:
             api_key = ApiKey.check_key(key)
             if api_key is not None:
                 user = api_key.user
-        except:
+        except SQLAlchemyError:
             logger.debug('Could not determine user', exc_info=True)
 
-    if 'HTTP_X_API_KEY' in request.environ:
-        log_entry['environment']['HTTP_X_API_KEY'] = f'...REDACTED...'
-
     if user is not None:
         log_entry['user'] = user.username
 
     logger.debug('Request: %s', log_entry)
+
+
+class _LazyRepr:
+    # Object whose representation is obtained from a function, only when it
+    # is needed
+    __slots__ = ('func', )
+
+    def __init__(self, func):
+        self.func = func
+
+    def __repr__(self):
+        return repr(self.func())
+
+
+def _request_data(request):
+    # Large bodies, such as file uploads, are not read only to be logged
+    if request.content_length is None or request.content_length > _MAX_DATA_LENGTH_BYTES:
+        return f'<{request.content_length} bytes not logged>'
+    return request.data
+
+
+def _redacted_headers(headers):
+    return {
+        key: _redacted_value(key.lower(), value) if key.lower() in _REDACTED_HEADERS else value
+        for key, value in headers
+    }
+
+
+def _redacted_environ(environ):
+    return {
+        key: _redacted_value(key, value) if key in _REDACTED_ENVIRON else repr(value)
+        for key, value in environ.items()
+    }
+
+
+def _redacted_value(key, value):
+    if key in ('authorization', 'proxy-authorization',
+               'HTTP_AUTHORIZATION', 'HTTP_PROXY_AUTHORIZATION'):
+        return _redacted_authorization(value)
+    return '...REDACTED...'
+
+
+def _redacted_authorization(value):
+    # Keep the authorization type only, when there is one
+    auth_type, separator, _ = value.lstrip().partition(' ')
+    if auth_type and separator:
+        return f'{auth_type} ...REDACTED...'
+    return '...REDACTED...'
@@ -1,13 +1,15 @@
 from datetime import datetime, timedelta
-import base64
 import enum
+import functools
 import logging
-import os
+import secrets
 
+from flask import current_app
 from flask_login import UserMixin
 from requests import codes
 from sqlalchemy.dialects.postgresql import JSONB, UUID
-from sqlalchemy.sql import func
+from sqlalchemy.orm import contains_eager, joinedload, raiseload
+from sqlalchemy.sql import and_, func, or_
 from sqlalchemy.schema import Index, UniqueConstraint, CheckConstraint
 from werkzeug.security import check_password_hash, generate_password_hash
 
@@ -20,6 +22,18 @@ from quetzal.app.api.exceptions import (
 logger = logging.getLogger(__name__)
 
 
+def _strict_loading(query):
+    """Forbid the lazy loads of a query when ``QUETZAL_STRICT_LOADING`` is set
+
+    Accessing a relationship of the queried objects that was not loaded by
+    the query then raises an exception instead of emitting a query. Objects
+    that are already in the session are still available.
+    """
+    if current_app.config.get('QUETZAL_STRICT_LOADING', False):
+        return query.options(raiseload('*', sql_only=True))
+    return query
+
+
 roles_users_table = db.Table('roles_users',
                              db.Column('fk_user_id', db.Integer(), db.ForeignKey('user.id')),
                              db.Column('fk_role_id', db.Integer(), db.ForeignKey('role.id')),
@@ -188,7 +202,7 @@ class User(UserMixin, db.Model):
         now = datetime.utcnow()
         if self.token and self.token_expiration > now + timedelta(seconds=60):
             return self.token
-        self.token = base64.b64encode(os.urandom(24)).decode('utf-8')
+        self.token = secrets.token_urlsafe(24)
         self.token_expiration = now + timedelta(seconds=expires_in)
         db.session.add(self)
         return self.token
@@ -222,11 +236,16 @@ class User(UserMixin, db.Model):
             was not found or it was expired.
 
         """
+        # Tokens always fill the token column: do not query the database
+        # for tokens that cannot exist
+        if not token or len(token) != User.token.type.length:
+            return None
         user = User.query.filter_by(token=token).first()
-        if user is None or user.token_expiration < datetime.utcnow():
+        now = datetime.utcnow()
+        if user is None or user.token_expiration < now:
             return None
         logger.debug('Token still valid for %d seconds',
-                     (user.token_expiration - datetime.utcnow()).total_seconds())
+                     (user.token_expiration - now).total_seconds())
         return user
 
     def __repr__(self):
@@ -242,7 +261,9 @@ class ApiKey(db.Model):
 
     @staticmethod
     def check_key(key):
-        apikey = ApiKey.query.filter_by(key=key).first()
+        # The user is always needed, load it in the same query
+        query = _strict_loading(ApiKey.query.options(joinedload(ApiKey.user)))
+        apikey = query.filter_by(key=key).first()
         if apikey is None:
             return None
         return apikey
@@ -410,26 +431,30 @@ class WorkspaceState(enum.Enum):
     """
 
     @staticmethod
+    @functools.lru_cache(maxsize=1)
     def transitions():
-        """Get the valid transition table for workspace states"""
+        """Get the valid transition table for workspace states
+
+        The table is constant: it is created once and shared by all calls.
+        """
         ws = WorkspaceState  # synonym for shorter code
         return {
-            None: {ws.INITIALIZING},
-            ws.INITIALIZING: {ws.READY, ws.INVALID},
-            ws.READY: {ws.SCANNING, ws.UPDATING, ws.COMMITTING, ws.DELETING},
-            ws.SCANNING: {ws.READY},
-            ws.UPDATING: {ws.READY, ws.INVALID},
-            ws.COMMITTING: {ws.READY, ws.CONFLICT},
-            ws.DELETING: {ws.DELETED, ws.INVALID},
-            ws.INVALID: {ws.UPDATING, ws.DELETING},
-            ws.CONFLICT: {ws.UPDATING, ws.DELETING},
-            ws.DELETED: {},
+            None: frozenset({ws.INITIALIZING}),
+            ws.INITIALIZING: frozenset({ws.READY, ws.INVALID}),
+            ws.READY: frozenset({ws.SCANNING, ws.UPDATING, ws.COMMITTING, ws.DELETING}),
+            ws.SCANNING: frozenset({ws.READY}),
+            ws.UPDATING: frozenset({ws.READY, ws.INVALID}),
+            ws.COMMITTING: frozenset({ws.READY, ws.CONFLICT}),
+            ws.DELETING: frozenset({ws.DELETED, ws.INVALID}),
+            ws.INVALID: frozenset({ws.UPDATING, ws.DELETING}),
+            ws.CONFLICT: frozenset({ws.UPDATING, ws.DELETING}),
+            ws.DELETED: frozenset(),
         }
 
     @staticmethod
     def valid_transition(from_value, to_value):
         """Determine if a state transition is valid"""
-        return to_value in WorkspaceState.transitions().get(from_value, {})
+        return to_value in WorkspaceState.transitions().get(from_value, frozenset())
 
 
 class Workspace(db.Model):
@@ -534,7 +559,9 @@ class Workspace(db.Model):
     @staticmethod
     def get_or_404(wid):
         """Get a workspace by id or raise a :py:class:`quetzal.app.api.exceptions.ObjectNotFoundException`"""
-        w = Workspace.query.get(wid)
+        # The owner is needed by most endpoints, load it in the same query.
+        # The other relationships of a workspace are dynamic
+        w = Workspace.query.options(joinedload(Workspace.owner)).get(wid)
         if w is None:
             raise ObjectNotFoundException(status=codes.not_found,
                                           title='Not found',
@@ -556,16 +583,24 @@ class Workspace(db.Model):
         """Get the base family instance associated with this workspace"""
         return self.families.filter_by(name='base').one()
 
-    def get_previous_metadata(self):
+    def get_previous_metadata(self, family_names=None):
         """Get the global metadata of this workspace
 
         The global metadata is the metadata that already has been committed,
         but it must also have a version value that is under the values declared
         for this workspace.
+
+        Parameters
+        ----------
+        family_names: set, optional
+            Names of the families of this workspace, when they have already
+            been retrieved. If not set, they are queried from the database.
         """
         # Important note: there can be repeated entries!
         reference = self.fk_last_metadata_id
-        related_family_names = set(f.name for f in self.families.all())
+        related_family_names = family_names
+        if related_family_names is None:
+            related_family_names = self._get_family_names()
         previous_meta = (
             Metadata
             .query
@@ -580,15 +615,23 @@ class Workspace(db.Model):
             previous_meta = previous_meta.filter(Metadata.id <= reference)
         return previous_meta
 
-    def get_current_metadata(self):
+    def get_current_metadata(self, family_names=None):
         """Get the metadata that has been added or modified in this workspace
 
         In contrast to :py:meth:`get_previous_metadata`, this function only
         retrieves the metadata that has been changed on this workspace after
         its creation.
+
+        Parameters
+        ----------
+        family_names: set, optional
+            Names of the families of this workspace, when they have already
+            been retrieved. If not set, they are queried from the database.
         """
         # Important note: there can be repeated entries!
-        related_family_names = set(f.name for f in self.families.all())
+        related_family_names = family_names
+        if related_family_names is None:
+            related_family_names = self._get_family_names()
         workspace_meta = (
             Metadata
             .query
@@ -598,49 +641,126 @@ class Workspace(db.Model):
         )
         return workspace_meta
 
-    def get_metadata(self):
+    def get_metadata(self, family_names=None):
         """Get a union of the previous and new metadata of this workspace
 
-        This function uses a combination of the results of
+        This function combines the entries of
         :py:meth:`get_previous_metadata` and :py:meth:`get_current_metadata`
         to obtain the merged version of both. This represents the definitive
         metadata of each file, regardless of changes before or after the
         creation of this workspace.
 
+        Parameters
+        ----------
+        family_names: set, optional
+            Names of the families of this workspace, when they have already
+            been retrieved. If not set, they are queried from the database.
+
         """
         # Important note: this one does not have repeated entries!
+        # The previous and current metadata are selected by a single query
+        # with a condition that covers both, instead of the union of
+        # :py:meth:`get_previous_metadata` and :py:meth:`get_current_metadata`.
+        # This avoids materializing both results, joining them again with the
+        # family table and then sorting them for the distinct
+        previous_condition = Family.fk_workspace_id.is_(None)
+        if self.fk_last_metadata_id is not None:
+            # Same rule as get_previous_metadata: without a reference, there
+            # was no metadata before
+            previous_condition = and_(previous_condition,
+                                      Metadata.id <= self.fk_last_metadata_id)
+        if family_names is None:
+            family_names = self._get_family_names()
         merged_metadata = (
-            self.get_previous_metadata()
-            .union(
-                self.get_current_metadata()
-            )
-            .join(Family)  # Need to join again with family to use it in the distinct
+            Metadata
+            .query
+            .join(Family)
+            .filter(Family.name.in_(family_names),
+                    or_(previous_condition,
+                        Family.fk_workspace_id == self.id))
             .distinct(Metadata.id_file, Family.name)
             .order_by(Metadata.id_file, Family.name, Metadata.id.desc())
         )
         return merged_metadata
 
+    def _get_family_names(self):
+        return {name for name, in self.families.with_entities(Family.name)}
+
     def has_file(self, uuid):
+        return bool(self.existing_file_ids([uuid]))
+
+    def existing_file_ids(self, uuids):
+        """Get which of several files exist in this workspace
+
+        A file exists when it has base metadata in this workspace, or in the
+        global workspace until the reference of this workspace, as in
+        :py:meth:`Metadata.get_latest`. All the files are verified with at
+        most two queries, instead of two queries per file.
+
+        Parameters
+        ----------
+        uuids: iterable
+            Identifiers of the files to verify.
+
+        Returns
+        -------
+        set
+            The identifiers, as :py:class:`uuid.UUID`, of the files that exist.
+        """
+        uuids = set(uuids)
+        if not uuids:
+            return set()
+
         base = self.get_base_family()
-        latest = Metadata.get_latest(uuid, base)
-        return latest is not None
+        existing = {
+            id_file for id_file, in
+            Metadata.query
+            .filter(Metadata.id_file.in_(uuids),
+                    Metadata.fk_family_id == base.id)
+            .with_entities(Metadata.id_file)
+            .distinct()
+        }
+        # Files not found in the workspace may exist on the global workspace,
+        # but only until the reference of this workspace (none when there is
+        # no reference)
+        if len(existing) < len(uuids) and self.fk_last_metadata_id is not None:
+            existing.update(
+                id_file for id_file, in
+                Metadata.query
+                .join(Family)
+                .filter(Metadata.id_file.in_(uuids),
+                        Family.fk_workspace_id.is_(None),
+                        Family.name == base.name,
+                        Metadata.id <= self.fk_last_metadata_id)
+                .with_entities(Metadata.id_file)
+                .distinct()
+            )
+        return existing
 
     def __repr__(self):
         return f'<Workspace {self.id} [name="{self.name}" ' \
                f'state={self.state.name if self.state else "unset"}] ' \
                f'view={self.pg_schema_name}>'
 
-    def to_dict(self):
+    def to_dict(self, families=None):
         """Return a dictionary representation of the workspace
 
         This is used in particular to adhere to the OpenAPI specification of
         workspace details objects.
 
+        Parameters
+        ----------
+        families: list, optional
+            Families of this workspace, when they have already been loaded.
+            If not set, they are queried from the database.
+
         Returns
         -------
         dict
             Dictionary representation of this object.
         """
+        if families is None:
+            families = self.families
         return {
             'id': self.id,
             'name': self.name,
@@ -650,7 +770,7 @@ class Workspace(db.Model):
             'creation_date': self.creation_date,
             'temporary': self.temporary,
             'data_url': self.data_url,
-            'families': {f.name: f.version for f in self.families},
+            'families': {f.name: f.version for f in families},
         }
 
 
@@ -691,7 +811,9 @@ class Family(db.Model):
         UniqueConstraint('name', 'fk_workspace_id'),
         # Do not allow the version and workspace to be simultaneously null
         CheckConstraint('version IS NOT NULL OR fk_workspace_id IS NOT NULL',
-                        name='simul_null_check')
+                        name='simul_null_check'),
+        # Index on workspace and id together, to find global families quickly
+        Index('ix_family_workspace_id', 'fk_workspace_id', 'id'),
     )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -748,6 +870,18 @@ class Metadata(db.Model):
         CheckConstraint("json ? 'id'", name='check_id'),
         # TODO: add constraint check file_id == json->'id' ?
         # TODO: add index on id? Would it be useful? For jsonb indices, see https://stackoverflow.com/a/17808864/227103
+        # Note that a GIN index on the json column would only be used by
+        # containment queries (@>), but the metadata is filtered with the ->>
+        # operator, which needs an expression index on each key
+        # Index on family and id together, to find the latest metadata of a family quickly
+        Index('ix_metadata_family_id', 'fk_family_id', 'id'),
+        # Index on file, family and id (newest first), to find the latest
+        # metadata of a file on a family, or the distinct metadata per file
+        # and family, with an ordered index scan instead of a sort
+        Index('ix_metadata_file_family_id', 'id_file', 'fk_family_id', db.text('id DESC')),
+        # Index on the file state, which is used to find the ready, deleted
+        # or temporary files without reading every metadata entry
+        Index('ix_metadata_state', db.text("(json->>'state')")),
     )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -823,7 +957,7 @@ class Metadata(db.Model):
         :py:func:`Workspace.get_current_metadata`, and
         :py:func:`Workspace.get_metadata`.
         """
-        latest = Metadata.query.filter_by(id_file=file_id, family=family).first()
+        latest = _strict_loading(Metadata.query).filter_by(id_file=file_id, family=family).first()
         # There is the only possible result (tested by test_update_metadata_db_records)
         if latest is not None:
             logger.info('Latest is from this workspace: %s', latest)
@@ -840,12 +974,13 @@ class Metadata(db.Model):
             reference = workspace.fk_last_metadata_id
 
         latest_global = (
-            Metadata
-            .query
+            _strict_loading(Metadata.query)
             .filter(Metadata.id_file == file_id,
                     Family.fk_workspace_id.is_(None),
                     Metadata.id <= reference)
             .join(Family)
+            # The family is already joined: load it from the same query
+            .options(contains_eager(Metadata.family))
             .filter(Family.name == family.name)
             .order_by(Metadata.id.desc())
             .first()
@@ -856,6 +991,25 @@ class Metadata(db.Model):
 
         return None
 
+    @staticmethod
+    def get_latest_global_id():
+        """Retrieve the identifier of the most recent global metadata entry
+
+        Returns
+        -------
+        int
+            The largest :py:attr:`Metadata.id` among all metadata associated
+            to a committed family, or ``None`` when there is no global
+            metadata at all.
+        """
+        return (
+            db.session.query(func.max(Metadata.id))
+            .select_from(Metadata)
+            .join(Family)
+            .filter(Family.fk_workspace_id.is_(None))
+            .scalar()
+        )
+
     @staticmethod
     def get_latest_global(file_id=None, family_name=None):
         """Retrieve the latest metadata of a file under a particular family
@@ -954,7 +1108,7 @@ class MetadataQuery(db.Model):
     @staticmethod
     def get_or_404(qid):
         """Get a workspace by id or raise an APIException"""
-        q = MetadataQuery.query.get(qid)
+        q = _strict_loading(MetadataQuery.query).get(qid)
         if q is None:
             raise ObjectNotFoundException(status=codes.not_found,
                                           title='Not found',
@@ -44,7 +44,7 @@ class CommitWorkspacePermission(Permission):
 
 
 def load_identity(sender, identity):
-    from quetzal.app.models import User
+    from quetzal.app.models import User, Workspace
     user = User.query.get(identity.id)
 
     # Inactive users are not authorized to anything
@@ -56,9 +56,11 @@ def load_identity(sender, identity):
         identity.provides.add(RoleNeed(role.name))
 
     # Add workspace authorizations:
-    # The owner of a workspace can read and write to it
-    for workspace in user.workspaces:
-        identity.provides.add(ReadWorkspaceNeed(workspace.id))
-        identity.provides.add(WriteWorkspaceNeed(workspace.id))
+    # The owner of a workspace can read and write to it.
+    # Only the workspace ids are needed, there is no need to load the whole
+    # workspace objects
+    for workspace_id, in user.workspaces.with_entities(Workspace.id):
+        identity.provides.add(ReadWorkspaceNeed(workspace_id))
+        identity.provides.add(WriteWorkspaceNeed(workspace_id))
 
     return identity
@@ -6,11 +6,24 @@ from unittest import mock
 from uuid import uuid4
 
 import pytest
-from sqlalchemy import func
+from sqlalchemy import event, func
 
 from quetzal.app.models import Family, Metadata, Workspace, WorkspaceState
 
 
+@pytest.fixture(scope='function')
+def sql_statements(db):
+    """List of the SQL statements sent to the database during a test"""
+    statements = []
+
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', _before_cursor_execute)
+    yield statements
+    event.remove(db.engine, 'before_cursor_execute', _before_cursor_execute)
+
+
 @pytest.fixture(scope='function')
 def make_workspace(db, db_session, user, request):
     """Factory method to create workspaces for unit tests"""
@@ -0,0 +1,118 @@
+"""Unit tests for the entity tags of the query results"""
+import pytest
+from requests import codes
+
+from quetzal.app.api.data.query import details, details_w
+from quetzal.app.models import MetadataQuery, QueryDialect
+
+
+@pytest.fixture(scope='function')
+def make_query(db_session, user):
+    """Factory method to create metadata queries for unit tests"""
+
+    def _make_query(workspace=None, dialect=QueryDialect.POSTGRESQL):
+        query = MetadataQuery(dialect=dialect, code='SELECT * FROM base', workspace=workspace, owner=user)
+        db_session.add(query)
+        db_session.commit()
+        return query
+
+    return _make_query
+
+
+@pytest.fixture(scope='function')
+def run_query(mocker):
+    """Mock the execution of a query, which needs the views of a schema"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    return mocker.patch('quetzal.app.api.data.query._run_query', return_value={'results': []})
+
+
+def _global_details(app, query, user, query_string='', etag=None):
+    headers = {'If-None-Match': etag} if etag is not None else {}
+    with app.test_request_context(query_string=query_string, headers=headers):
+        return details(qid=query.id, user=user)
+
+
+def _workspace_details(app, workspace, query, user, query_string='', etag=None):
+    headers = {'If-None-Match': etag} if etag is not None else {}
+    with app.test_request_context(query_string=query_string, headers=headers):
+        return details_w(wid=workspace.id, qid=query.id, user=user)
+
+
+def test_query_details_not_modified(app, user, make_query, run_query, mocker):
+    """Query details responds 304 when the results are the same"""
+    mocker.patch('quetzal.app.api.data.query._global_views_version', return_value='1,2,3')
+    query = make_query()
+
+    _, code, headers = _global_details(app, query, user)
+    assert code == codes.ok
+
+    response, code_not_modified, headers_not_modified = _global_details(app, query, user, etag=headers['ETag'])
+    assert code_not_modified == codes.not_modified
+    assert response is None
+    assert headers_not_modified['ETag'] == headers['ETag']
+    # The query was only executed for the first response
+    run_query.assert_called_once()
+
+
+def test_query_details_global_views_update(app, user, make_query, run_query, mocker):
+    """Query details has a new entity tag once the global views are updated"""
+    version_mock = mocker.patch('quetzal.app.api.data.query._global_views_version', return_value='1,2,3')
+    query = make_query()
+    _, _, headers = _global_details(app, query, user)
+
+    # The global views were recreated, their tables are new
+    version_mock.return_value = '4,5,6'
+    _, code, new_headers = _global_details(app, query, user, etag=headers['ETag'])
+
+    assert code == codes.ok
+    assert new_headers['ETag'] != headers['ETag']
+    assert run_query.call_count == 2
+
+
+def test_query_details_workspace_scan(app, db_session, user, make_workspace, make_query, run_query):
+    """Workspace query details has a new entity tag once the workspace is scanned again"""
+    workspace = make_workspace()
+    workspace.pg_schema_name = 'q_schema_1'
+    db_session.add(workspace)
+    db_session.commit()
+    query = make_query(workspace=workspace)
+
+    _, code, headers = _workspace_details(app, workspace, query, user)
+    assert code == codes.ok
+    _, code, _ = _workspace_details(app, workspace, query, user, etag=headers['ETag'])
+    assert code == codes.not_modified
+
+    # A new scan creates a new schema
+    workspace.pg_schema_name = 'q_schema_2'
+    db_session.add(workspace)
+    db_session.commit()
+    _, code, new_headers = _workspace_details(app, workspace, query, user, etag=headers['ETag'])
+
+    assert code == codes.ok
+    assert new_headers['ETag'] != headers['ETag']
+
+
+@pytest.mark.parametrize('query_string', ['page=2', 'per_page=5', 'page=2&per_page=5'])
+def test_query_details_pages(app, user, make_query, run_query, mocker, query_string):
+    """Query details has a different entity tag for each page"""
+    mocker.patch('quetzal.app.api.data.query._global_views_version', return_value='1,2,3')
+    query = make_query()
+    _, _, headers = _global_details(app, query, user)
+
+    _, code, page_headers = _global_details(app, query, user, query_string=query_string, etag=headers['ETag'])
+
+    assert code == codes.ok
+    assert page_headers['ETag'] != headers['ETag']
+
+
+@pytest.mark.parametrize('query_string', ['page=1', 'per_page=100', 'page=1&per_page=100'])
+def test_query_details_default_pages(app, user, make_query, run_query, mocker, query_string):
+    """Query details has the same entity tag when the default page is explicit"""
+    mocker.patch('quetzal.app.api.data.query._global_views_version', return_value='1,2,3')
+    query = make_query()
+    _, _, headers = _global_details(app, query, user)
+
+    _, code, page_headers = _global_details(app, query, user, query_string=query_string, etag=headers['ETag'])
+
+    assert code == codes.not_modified
+    assert page_headers['ETag'] == headers['ETag']
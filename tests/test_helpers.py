@@ -1,6 +1,8 @@
 import io
 
 from quetzal.app.helpers.files import get_readable_info
+from quetzal.app.helpers.pagination import paginate
+from quetzal.app.models import Family
 
 
 def test_readable_info():
@@ -9,3 +11,96 @@ def test_readable_info():
     md5, size = get_readable_info(buffer)
     assert md5 == '5eb63bbbe01eeed093cb22bb8f5acdc3'
     assert size == 11
+
+
+def test_readable_info_restores_position():
+    buffer = io.BytesIO(b'skip hello world')
+    buffer.seek(5)
+    md5, size = get_readable_info(buffer)
+    assert md5 == '5eb63bbbe01eeed093cb22bb8f5acdc3'
+    assert size == 11
+    assert buffer.tell() == 5
+
+
+def test_paginate_keyset(db_session, make_family):
+    ids = [make_family().id for _ in range(4)]
+    query = Family.query.filter(Family.id.in_(ids))
+
+    pager = paginate(query, per_page=2, keyset_column=Family.id)
+    seen = [family.id for family in pager.items]
+    assert pager.response_object()['next_cursor'] == seen[-1]
+
+    pager = pager.next()
+    seen.extend(family.id for family in pager.items)
+    # The last page is full, but there is no next page
+    assert pager.response_object()['next_cursor'] is None
+    assert seen == sorted(ids)
+
+
+def test_paginate_keyset_cursor_argument(app, db_session, make_family):
+    ids = [make_family().id for _ in range(3)]
+    query = Family.query.filter(Family.id.in_(ids))
+
+    with app.test_request_context(f'/?cursor={ids[0]}&per_page=5&page=3'):
+        pager = paginate(query, keyset_column=Family.id)
+
+    # The page number is ignored when there is a cursor
+    assert [family.id for family in pager.items] == ids[1:]
+    assert pager.total == 3
+    assert pager.response_object()['next_cursor'] is None
+
+
+def test_paginate_overfetch_has_next(db_session, make_family):
+    ids = [make_family().id for _ in range(3)]
+    query = Family.query.filter(Family.id.in_(ids)).order_by(Family.id)
+
+    pager = paginate(query, page=1, per_page=2, with_total=False)
+    assert [family.id for family in pager.items] == ids[:2]
+    assert pager.has_next
+
+    pager = paginate(query, page=2, per_page=2, with_total=False)
+    assert [family.id for family in pager.items] == ids[2:]
+    assert not pager.has_next
+
+
+def test_paginate_last_page_total(db_session, make_family, mocker):
+    ids = [make_family().id for _ in range(5)]
+    query = Family.query.filter(Family.id.in_(ids)).order_by(Family.id)
+    count_mock = mocker.patch.object(type(query), 'count')
+
+    pager = paginate(query, page=3, per_page=2)
+
+    # The total is known from the last page, without counting
+    count_mock.assert_not_called()
+    assert pager.total == 5
+    assert pager.pages == 3
+
+
+def test_paginate_without_total_response(db_session, make_family, mocker):
+    ids = [make_family().id for _ in range(3)]
+    query = Family.query.filter(Family.id.in_(ids)).order_by(Family.id)
+    count_mock = mocker.patch.object(type(query), 'count')
+
+    pager = paginate(query, page=1, per_page=2, with_total=False)
+    response = pager.response_object()
+
+    count_mock.assert_not_called()
+    assert pager.total is None
+    assert response['has_next'] is True
+    assert 'total' not in response
+    assert 'pages' not in response
+    assert len(response['results']) == 2
+
+
+def test_paginate_keyset_without_cursor_uses_page(app, db_session, make_family):
+    ids = [make_family().id for _ in range(5)]
+    query = Family.query.filter(Family.id.in_(ids))
+
+    with app.test_request_context('/?page=2&per_page=2'):
+        pager = paginate(query, keyset_column=Family.id)
+
+    # Without a cursor, the page is still the second one
+    assert [family.id for family in pager.items] == ids[2:4]
+    assert pager.page == 2
+    assert pager.total == 5
+    assert pager.response_object()['next_cursor'] == ids[3]
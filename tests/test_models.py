@@ -1,3 +1,5 @@
+from uuid import UUID, uuid4
+
 from quetzal.app.models import (
     Family, MetadataQuery, Metadata, User, Role, Workspace
 )
@@ -10,3 +12,32 @@ def test_registry(db):
                          if isinstance(cls, type) and issubclass(cls, db.Model))
     expected_set = {Family, Metadata, MetadataQuery, User, Role, Workspace}
     assert registered_set == expected_set
+
+
+def test_latest_global_id_ignores_workspace_metadata(db_session, committed_file, make_family, workspace):
+    """Latest global metadata id is not affected by workspace metadata"""
+    latest_id = Metadata.get_latest_global_id()
+    expected_id = max(m.id for m in Metadata.query.all() if m.family.workspace is None)
+    assert latest_id == expected_id
+
+    family = make_family(name='local', workspace=workspace)
+    metadata = Metadata(id_file=committed_file['id'], family=family,
+                        json={'id': committed_file['id']})
+    db_session.add(metadata)
+    db_session.commit()
+
+    assert Metadata.get_latest_global_id() == latest_id
+
+
+def test_existing_file_ids(db_session, committed_file, make_workspace, upload_file, file_id):
+    """Existing files are found in the workspace and in the global workspace"""
+    workspace = make_workspace(families={'base': None})
+    workspace.fk_last_metadata_id = Metadata.get_latest_global_id()
+    db_session.commit()
+    local_id = upload_file(workspace)
+    missing_id = uuid4()
+
+    existing = workspace.existing_file_ids([file_id, UUID(local_id), missing_id])
+    assert existing == {file_id, UUID(local_id)}
+    assert workspace.has_file(file_id)
+    assert not workspace.has_file(missing_id)
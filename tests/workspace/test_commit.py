@@ -1,8 +1,10 @@
 """Unit tests for committing a workspace and detecting conflicts """
+import threading
+
 import pytest
 
-from quetzal.app.api.data.tasks import merge
-from quetzal.app.api.exceptions import Conflict
+from quetzal.app.api.data.tasks import _commit_files, _copy_file, _uncommit_files, merge
+from quetzal.app.api.exceptions import CommitFilesException, Conflict
 
 
 def test_commit_success():
@@ -45,6 +47,80 @@ def test_commit_success_metadata_modification():
     raise NotImplementedError
 
 
+def test_commit_files_keeps_order(app, mocker):
+    mocker.patch('quetzal.app.api.data.tasks._commit_file',
+                 side_effect=lambda file_id, file_url, client=None: (f'file:///data/{file_id}', True))
+    files = [(str(i), f'file:///workspace/{i}') for i in range(20)]
+    urls, created_urls = _commit_files(files)
+    assert urls == [f'file:///data/{i}' for i in range(20)]
+    assert sorted(created_urls) == sorted(urls)
+
+
+def test_commit_files_failure_keeps_copied_urls(app, mocker):
+    # All copies run at the same time, so the failure happens after the
+    # other copies have started
+    barrier = threading.Barrier(3)
+
+    def _commit_file(file_id, file_url, client=None):
+        barrier.wait(timeout=5)
+        if file_id == 'bad':
+            raise OSError('Mocked copy error')
+        return f'file:///data/{file_id}', True
+
+    mocker.patch('quetzal.app.api.data.tasks._commit_file', side_effect=_commit_file)
+    files = [('a', 'file:///workspace/a'), ('bad', 'file:///workspace/bad'), ('b', 'file:///workspace/b')]
+    with pytest.raises(CommitFilesException) as excinfo:
+        _commit_files(files)
+    # The copies that succeeded are reported so they can be deleted
+    assert sorted(excinfo.value.urls) == ['file:///data/a', 'file:///data/b']
+
+
+def test_commit_files_failure_keeps_committed_files(app, tmp_path, mocker):
+    data_dir = tmp_path / 'data'
+    workspace_dir = tmp_path / 'workspace'
+    data_dir.mkdir()
+    workspace_dir.mkdir()
+    mocker.patch.dict(app.config, {'QUETZAL_DATA_STORAGE': 'file', 'QUETZAL_FILE_DATA_DIR': str(data_dir)})
+    # A committed file whose path was changed keeps its global url
+    committed = data_dir / 'committed'
+    committed.write_bytes(b'committed contents')
+    # A new file of the workspace
+    new = workspace_dir / 'new'
+    new.write_bytes(b'new contents')
+    files = [
+        ('committed', f'file://{committed}'),
+        ('new', f'file://{new}'),
+        ('missing', f'file://{workspace_dir / "missing"}'),
+    ]
+
+    with pytest.raises(CommitFilesException) as excinfo:
+        _commit_files(files)
+    _uncommit_files(excinfo.value.urls)
+
+    # Only the file created by this commit is deleted
+    assert excinfo.value.urls == [f'file://{(data_dir / "new").resolve()}']
+    assert committed.read_bytes() == b'committed contents'
+    assert not (data_dir / 'new').exists()
+
+
+def test_copy_file(tmp_path):
+    source = tmp_path / 'source'
+    source.write_bytes(b'hello world')
+    target = tmp_path / 'target'
+    _copy_file(str(source), str(target))
+    assert target.read_bytes() == b'hello world'
+    # No temporary file is left behind
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['source', 'target']
+
+
+def test_copy_file_same_file(tmp_path):
+    # A committed file whose metadata changed is copied onto itself
+    source = tmp_path / 'source'
+    source.write_bytes(b'hello world')
+    _copy_file(str(source), str(source))
+    assert source.read_bytes() == b'hello world'
+
+
 @pytest.mark.parametrize('predecessor,theirs,mine,expected', [
     ({}, {}, {}, {}),                          # No change at all
     ({}, {}, {'x': 1}, {'x': 1}),              # Mine branch adds
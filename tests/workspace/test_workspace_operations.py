@@ -145,6 +145,40 @@ def test_details_workspace_success(app, db_session, workspace, mocker):
     assert workspace.to_dict() == result
 
 
+def test_details_workspace_query_count(app, db_session, make_workspace, sql_statements, mocker):
+    """Retrieving details does not load the workspace relationships one by one"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    workspace = make_workspace(families={'base': 0, 'other': 0})
+    wid = workspace.id
+    # Forget the loaded objects, as in a new request
+    db_session.expunge_all()
+    sql_statements.clear()
+
+    with app.test_request_context():
+        result, code = details(wid=wid)
+
+    # The workspace with its owner, then its families
+    assert len(sql_statements) <= 2
+    assert result['families'] == {'base': 0, 'other': 0}
+
+
+def test_fetch_workspaces_query_count(app, db_session, user, make_workspace, sql_statements, mocker):
+    """Fetching workspaces does not load the relationships of each workspace"""
+    mocker.patch('flask_principal.Permission.can', return_value=True)
+    for _ in range(5):
+        make_workspace(families={'base': 0})
+    db_session.expunge_all()
+    sql_statements.clear()
+
+    with app.test_request_context(query_string='per_page=100000'):
+        result, code = fetch(user=user)
+
+    # The workspaces with their owners, their count and their families,
+    # regardless of the number of workspaces
+    assert len(result['results']) >= 5
+    assert len(sql_statements) <= 3
+
+
 def test_details_workspace_missing(app, db_session):
     """Retrieving details fails for workspaces that do not exist"""
 
@@ -4,17 +4,19 @@ import pytest
 from celery.exceptions import Retry
 from google.cloud.storage import Client
 from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
 
 from quetzal.app.models import Family, Workspace, WorkspaceState
 from quetzal.app.api.data.workspace import create
 from quetzal.app.api.data.tasks import (
-    wait_for_workspace, init_workspace, init_data_bucket, delete_workspace
+    wait_for_workspace, init_workspace, init_data_bucket, init_workspace_and_bucket,
+    delete_workspace, rebuild_global_views, update_global_views, _update_global_views
 )
 from quetzal.app.api.exceptions import WorkerException
 
 
 def test_create_workspace_backend_tasks(app, user, db_session, mocker):
-    """Workspace create triggers three tasks in the correct order and args"""
+    """Workspace create triggers two tasks in the correct order and args"""
     mocker.patch('flask_principal.Permission.can', return_value=True)
     request = {
         'name': 'unit-test-failed-queue',
@@ -27,9 +29,9 @@ def test_create_workspace_backend_tasks(app, user, db_session, mocker):
     run_mock = mocker.patch('quetzal.app.helpers.celery._mockable_call')
     result, code = create(body=request, user=user)
 
-    # There should have been three calls to a celery task:
-    # wait_for_workspace, init_workspace and init_data_bucket
-    assert run_mock.call_count == 3
+    # There should have been two calls to a celery task:
+    # wait_for_workspace and init_workspace_and_bucket
+    assert run_mock.call_count == 2
 
     # Each call should have the same id as argument
     # Moreover, call_args_list is a list of unittest.mock.Call objects, which
@@ -37,20 +39,18 @@ def test_create_workspace_backend_tasks(app, user, db_session, mocker):
     # See docs on: https://docs.python.org/3/library/unittest.mock.html#unittest.mock.call
     args1, kwargs1 = run_mock.call_args_list[0]
     args2, kwargs2 = run_mock.call_args_list[1]
-    args3, kwargs3 = run_mock.call_args_list[2]
 
     # The signature to verify here comes from the celery_helper.mockable_call
     # function. Let's verify it was called in the correct order and with the
     # same workspace id
     #
     # kwargs should be empty
-    assert {} == kwargs1 == kwargs2 == kwargs3
+    assert {} == kwargs1 == kwargs2
     # correct order
     assert args1[1].name == wait_for_workspace.name
-    assert args2[1].name == init_workspace.name
-    assert args3[1].name == init_data_bucket.name
+    assert args2[1].name == init_workspace_and_bucket.name
     # same workspace id
-    assert args1[2] == args2[2] == args3[2] == result['id']
+    assert args1[2] == args2[2] == result['id']
 
 
 def test_wait_for_workspace_success(workspace, db_session):
@@ -228,6 +228,24 @@ def test_init_data_bucket_invalid_state(db_session, make_workspace, state):
         init_data_bucket(w.id)
 
 
+def test_init_workspace_and_bucket_success(db, db_session, make_workspace, mocker):
+    """Init workspace and bucket initializes families and bucket"""
+    # See test_init_data_bucket_correct_api for comments on these mocks
+    mocker.patch('google.auth.default',
+                 return_value=(None, 'mock-project'))
+    mocker.patch('quetzal.app.api.data.tasks.get_client',
+                 return_value=Client(project='mock-project'))
+    mocker.patch('google.cloud._http.JSONConnection.api_request')
+
+    w = make_workspace(state=WorkspaceState.INITIALIZING, families={'new': None})
+    init_workspace_and_bucket(w.id)
+
+    # Verify the families, workspace state and data_url have been updated
+    assert w.families.first().version is not None
+    assert w.state == WorkspaceState.READY
+    assert w.data_url is not None
+
+
 def test_delete_workspace_task_success(db_session, make_workspace, mocker):
     # See test_init_data_bucket_correct_api for comments on these mocks
     mocker.patch('google.auth.default',
@@ -287,5 +305,55 @@ def test_delete_workspace_task_invalid_state(db_session, make_workspace, state):
         delete_workspace(w.id)
 
 
+def test_update_global_views_failure_rolls_back(db_session, mocker):
+    """Update of the global views leaves the session usable when it fails"""
+    mocker.patch('quetzal.app.api.data.tasks._update_global_views',
+                 side_effect=OperationalError('statement', {}, 'Mocked operational error'))
+    rollback_mock = mocker.patch('quetzal.app.db.session.rollback')
+
+    with pytest.raises(OperationalError):
+        update_global_views(['base'])
+
+    rollback_mock.assert_called_once()
+
+
+def test_rebuild_global_views_recreates_all_views(mocker):
+    """Failed updates of the global views are followed by a full update"""
+    delay_mock = mocker.patch.object(update_global_views, 'delay')
+    rebuild_global_views('failed-task-id')
+    delay_mock.assert_called_once_with()
+
+
+def test_update_global_views_skips_unchanged(db_session, make_family, mocker):
+    """Update of the global views does nothing when no family changed"""
+    make_family(name='base', version=1, workspace=None)
+    # All global families have their table already
+    table_names = {name for name, in db_session.query(Family.name).filter(Family.fk_workspace_id.is_(None))}
+    mocker.patch('quetzal.app.api.data.tasks._schema_table_names', return_value=table_names | {'metadata'})
+    table_mock = mocker.patch('quetzal.app.api.data.tasks._update_global_table_views')
+    json_mock = mocker.patch('quetzal.app.api.data.tasks._update_global_json_views')
+
+    _update_global_views([])
+
+    table_mock.assert_not_called()
+    json_mock.assert_not_called()
+
+
+def test_update_global_views_adds_missing_families(db_session, make_family, mocker):
+    """Update of the global views recreates the families without a table"""
+    make_family(name='base', version=1, workspace=None)
+    family = make_family(version=1, workspace=None)
+    mocker.patch('quetzal.app.api.data.tasks._schema_table_names', return_value={'base', 'metadata'})
+    table_mock = mocker.patch('quetzal.app.api.data.tasks._update_global_table_views')
+    json_mock = mocker.patch('quetzal.app.api.data.tasks._update_global_json_views')
+
+    _update_global_views([])
+
+    args, kwargs = table_mock.call_args
+    assert family.name in args[2]
+    assert 'base' not in args[2]
+    json_mock.assert_called_once()
+
+
 # TODO: add test that uses mockable_call to verify that tasks are called by celery
 # This is only done for the create_workspace case but not for the others